@@ -0,0 +1,187 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from app import db
+from models import UsageRollup
+from config import USAGE_ACCOUNTING_ENABLED, USAGE_FLUSH_INTERVAL, USAGE_FLUSH_SIZE
+
+# period name => length in seconds
+PERIODS = {"hour": 3600, "day": 24 * 3600}
+DIRECTIONS = ("inbound", "outbound")
+
+UPSERT = text("""
+INSERT INTO usage_rollup (account_id, number, period, period_start, inbound, outbound)
+VALUES (:account_id, :number, :period, :period_start, :inbound, :outbound)
+ON CONFLICT (account_id, number, period, period_start)
+DO UPDATE SET inbound = usage_rollup.inbound + excluded.inbound, outbound = usage_rollup.outbound + excluded.outbound
+""")
+
+
+def period_start(ts, period):
+    return datetime.utcfromtimestamp(int(ts) // PERIODS[period] * PERIODS[period])
+
+
+class UsageRecorder(object):
+
+    """
+    Counts smses per account, number and period in memory, a background thread adds them to the rollups
+    in a single batched upsert. Counts of a failed flush are kept for the next one
+    """
+
+    def __init__(self, flush_interval, flush_size, enabled=True):
+
+        """
+        :param flush_interval: seconds between flushes
+        :param flush_size: number of pending rollups which triggers an early flush
+        :param enabled: record is a no-op if False
+        """
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.flushed = 0
+        self.failures = 0
+        # (account id, number, period, period start) => [inbound, outbound]
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+
+    def start(self):
+
+        """
+        Starts the flusher thread, once per process
+        :return: No return
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid != pid:
+                # counts inherited from the parent are flushed by the parent
+                self._pending = {}
+                thread = threading.Thread(target=self._run, name="usage-recorder")
+                thread.daemon = True
+                thread.start()
+                self._pid = pid
+
+    def record(self, account_id, number, direction, count=1, ts=None):
+
+        """
+        :param account_id: account sending or receiving the sms
+        :param number: number of the account
+        :param direction: "inbound" or "outbound"
+        :param count: number of smses
+        :param ts: unix time of the smses, now if not given
+        :return: No return
+        """
+        if not self.enabled or not count:
+            return
+
+        self.start()
+        ts = ts or time.time()
+        index = DIRECTIONS.index(direction)
+        with self._lock:
+            for period in PERIODS:
+                key = (account_id, "%s" % number, period, period_start(ts, period))
+                counts = self._pending.get(key)
+                if counts is None:
+                    counts = self._pending[key] = [0, 0]
+                counts[index] += count
+            pending = len(self._pending)
+
+        if pending >= self.flush_size:
+            self._wakeup.set()
+
+    def flush(self):
+
+        """
+        Adds pending counts to the rollups
+        :return: number of rollups written
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            rows = [dict(account_id=account_id, number=number, period=period, period_start=start,
+                         inbound=counts[0], outbound=counts[1])
+                    for (account_id, number, period, start), counts in pending.items()]
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(UPSERT, rows)
+            except Exception:
+                self.failures += 1
+                self._restore(pending)
+                raise
+
+            self.flushed += len(rows)
+            return len(rows)
+
+    def clear(self):
+
+        """
+        Drops pending counts
+        :return: No return
+        """
+        with self._lock:
+            self._pending = {}
+
+    def _restore(self, pending):
+        with self._lock:
+            for key, counts in pending.items():
+                current = self._pending.setdefault(key, [0, 0])
+                current[0] += counts[0]
+                current[1] += counts[1]
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print e
+
+
+usage_recorder = UsageRecorder(USAGE_FLUSH_INTERVAL, USAGE_FLUSH_SIZE, USAGE_ACCOUNTING_ENABLED)
+
+
+@atexit.register
+def _flush_on_exit():
+    if usage_recorder._pid == os.getpid():
+        try:
+            usage_recorder.flush()
+        except Exception as e:
+            print e
+
+
+def query_usage(account_id, period, start, end, number=None):
+
+    """
+    Reads the rollups of an account, counts not flushed yet are not included
+    :param account_id: account id
+    :param period: "hour" or "day"
+    :param start: unix time, rollups of periods starting at or after it are returned
+    :param end: unix time, rollups of periods starting before it are returned
+    :param number: only rollups of this number if given
+    :return: list of dicts ordered by period start and number
+    """
+    query = UsageRollup.query.filter(
+        UsageRollup.account_id == account_id, UsageRollup.period == period,
+        UsageRollup.period_start >= period_start(start, period),
+        UsageRollup.period_start < datetime.utcfromtimestamp(end)
+    )
+    if number:
+        query = query.filter(UsageRollup.number == number)
+
+    return [dict(number=rollup.number, period_start=rollup.period_start.isoformat(), inbound=rollup.inbound,
+                 outbound=rollup.outbound)
+            for rollup in query.order_by(UsageRollup.period_start, UsageRollup.number)]
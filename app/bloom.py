@@ -0,0 +1,161 @@
+import hashlib
+import math
+import struct
+import threading
+import time
+
+
+class BloomFilter(object):
+
+    """
+    Compact set membership, may report false positives but never false negatives
+    """
+
+    def __init__(self, capacity, error_rate):
+
+        """
+        :param capacity: expected number of entries
+        :param error_rate: false positive rate at capacity
+        """
+        capacity = max(int(capacity), 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(int(round(float(self.size) / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+
+        """
+        Returns bit positions of item using double hashing
+        :param item: string
+        :return: generator of bit positions
+        """
+        if isinstance(item, unicode):
+            item = item.encode("utf-8")
+
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(item).digest())
+        return ((h1 + i * h2) % self.size for i in xrange(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def false_positive_rate(self):
+
+        """
+        Returns estimated false positive rate for the entries added so far
+        :return: rate between 0 and 1
+        """
+        return (1 - math.exp(-float(self.hashes) * self.count / self.size)) ** self.hashes
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+
+class ExpiringBloomFilter(object):
+
+    """
+    Bloom filter of entries which expire. Entries are grouped by their expiry time into buckets of
+    window / buckets seconds, every bucket is a separate filter which is dropped once all its entries have expired
+    """
+
+    def __init__(self, window, buckets, capacity, error_rate):
+
+        """
+        :param window: maximum expiry of an entry in seconds
+        :param buckets: number of buckets the window is split into
+        :param capacity: expected number of live entries
+        :param error_rate: false positive rate of every bucket at capacity
+        """
+        self.window = window
+        self.buckets = buckets
+        self.capacity = capacity
+        self.width = float(window) / buckets
+        self.bucket_capacity = float(capacity) / buckets
+        self.error_rate = error_rate
+        self.filters = {}
+        self._lock = threading.Lock()
+
+    def add(self, item, expiry):
+
+        """
+        Adds item which expires after expiry seconds
+        :param item: string
+        :param expiry: seconds, window is used if item never expires
+        :return: No return
+        """
+        now = time.time()
+        if expiry < 0:
+            expiry = self.window
+        bucket = int((now + expiry) // self.width)
+
+        with self._lock:
+            self._expire(now)
+            bloom = self.filters.get(bucket)
+            if bloom is None:
+                bloom = self.filters[bucket] = BloomFilter(self.bucket_capacity, self.error_rate)
+            bloom.add(item)
+
+    def __contains__(self, item):
+        current = int(time.time() // self.width)
+        return any(item in bloom for bucket, bloom in self.filters.items() if bucket >= current)
+
+    def clear(self):
+        with self._lock:
+            self.filters = {}
+
+    def empty(self):
+
+        """
+        :return: new empty filter of the same size
+        """
+        return ExpiringBloomFilter(self.window, self.buckets, self.capacity, self.error_rate)
+
+    def replace(self, other):
+
+        """
+        Replaces all the entries with the ones of other filter, lookups see either of them
+        :param other: ExpiringBloomFilter of the same size
+        :return: No return
+        """
+        with self._lock:
+            self.filters = other.filters
+
+    def _expire(self, now):
+
+        """
+        Drops buckets whose entries have all expired, must be called with lock held
+        :param now: current unix time
+        :return: No return
+        """
+        current = int(now // self.width)
+        for bucket in [bucket for bucket in self.filters if bucket < current]:
+            del self.filters[bucket]
+
+    def stats(self):
+
+        """
+        Returns sizing metrics
+        :return: dict of metric name => value
+        """
+        with self._lock:
+            self._expire(time.time())
+            filters = list(self.filters.values())
+
+        # a lookup is a false positive if any of the live buckets reports one
+        negative = 1.0
+        for bloom in filters:
+            negative *= 1 - bloom.false_positive_rate()
+
+        return {
+            "buckets": len(filters),
+            "entries": sum(bloom.count for bloom in filters),
+            "memory_bytes": sum(bloom.nbytes for bloom in filters),
+            "false_positive_rate": 1 - negative,
+        }
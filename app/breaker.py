@@ -0,0 +1,152 @@
+import functools
+import threading
+import time
+
+import redis
+
+# errors which count as redis being unavailable, script and command errors do not
+UNAVAILABLE_ERRORS = (redis.ConnectionError, redis.TimeoutError)
+# raised by BlockingConnectionPool once no connection was freed within its timeout
+POOL_EXHAUSTED_MESSAGE = "No connection available"
+
+
+def is_pool_exhausted(error):
+
+    """
+    Checks if error was raised waiting for a free connection, i.e. this process is saturated, not redis
+    :param error: exception
+    :return: True if the pool ran out of connections
+    """
+    return isinstance(error, redis.ConnectionError) and str(error).startswith(POOL_EXHAUSTED_MESSAGE)
+
+
+class CircuitOpenError(Exception):
+
+    """
+    Raised instead of calling redis while the circuit is open
+    """
+
+
+UNAVAILABLE_ERROR = "service temporarily unavailable, retry later"
+
+
+class ServiceUnavailable(Exception):
+
+    """
+    Raised by fail closed checks while redis is unavailable
+    """
+
+    def __init__(self, message=UNAVAILABLE_ERROR):
+        super(ServiceUnavailable, self).__init__(message)
+
+
+class CircuitBreaker(object):
+
+    """
+    Stops calling redis after failure_threshold consecutive connection failures or timeouts, so that requests
+    fall back right away instead of each waiting for the socket timeout. After reset_timeout seconds a single
+    call probes redis again, recover callbacks run once it succeeds. Calls which found the connection pool
+    exhausted fall back too but are not counted as failures, a burst of requests must not cut off redis
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = 0
+        self.opened_at = None
+        self.on_recover = []
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+
+        """
+        :return: True if redis should be called, only one probe is let through per reset_timeout while open
+        """
+        if self.opened_at is None:
+            return True
+
+        with self._lock:
+            if self.opened_at is not None and time.time() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.time()
+                return True
+
+        return False
+
+    def success(self):
+        if self.opened_at is None:
+            self.failures = 0
+            return
+
+        with self._lock:
+            recovered = self.opened_at is not None
+            self.failures = 0
+            self.opened_at = None
+
+        if recovered:
+            for callback in self.on_recover:
+                thread = threading.Thread(target=callback, name="%s-recover" % self.name)
+                thread.daemon = True
+                thread.start()
+
+    def failure(self, error=None):
+
+        """
+        Counts a failure, an error shared by coalesced callers is counted once
+        :param error: exception raised by the call
+        :return: No return
+        """
+        with self._lock:
+            if error is not None:
+                if getattr(error, "breaker_counted", False):
+                    return
+                error.breaker_counted = True
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    self.opened += 1
+                self.opened_at = time.time()
+
+    def call(self, func, *args, **kwargs):
+
+        """
+        Calls func unless the circuit is open
+        :raise CircuitOpenError: if the circuit is open
+        """
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+
+        try:
+            result = func(*args, **kwargs)
+        except UNAVAILABLE_ERRORS as e:
+            if not is_pool_exhausted(e):
+                self.failure(e)
+            raise
+
+        self.success()
+        return result
+
+    def fallback(self, fallback, on_fallback=None):
+
+        """
+        Decorator calling the function through the breaker and fallback with the same arguments
+        if redis is unavailable
+        :param fallback: function with the same signature
+        :param on_fallback: called with the name of the function every time fallback is used
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                try:
+                    return self.call(func, *args, **kwargs)
+                except UNAVAILABLE_ERRORS + (CircuitOpenError,):
+                    if on_fallback:
+                        on_fallback(func.__name__)
+                    return fallback(*args, **kwargs)
+            return wrapper
+        return decorator
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+# returned by TTLCache.get when key is not cached, so that None can be cached as a negative result
+MISSING = object()
+
+
+class TTLCache(object):
+
+    """
+    Bounded, thread safe LRU cache whose entries expire after ttl seconds
+    """
+
+    def __init__(self, maxsize, ttl):
+
+        """
+        :param maxsize: maximum number of entries, least recently used entry is evicted beyond it
+        :param ttl: default seconds after which an entry expires
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+
+        """
+        Returns cached value for key
+        :param key: cache key
+        :param default: returned if key is not cached or has expired
+        :return: cached value
+        """
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[1] < time.time():
+                self.misses += 1
+                return default
+
+            # re-insert so that the entry becomes most recently used
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+
+        """
+        Caches value for key
+        :param key: cache key
+        :param value: value to be cached
+        :param ttl: seconds after which entry expires, defaults to cache ttl
+        :return: No return
+        """
+        if ttl is None:
+            ttl = self.ttl
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+
+        """
+        Removes key from the cache
+        :param key: cache key
+        :return: No return
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+
+        """
+        Removes all the entries from the cache
+        :return: No return
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
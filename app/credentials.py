@@ -0,0 +1,81 @@
+import binascii
+import hashlib
+import hmac
+import os
+
+from cache import TTLCache
+from config import AUTH_HASH_ITERATIONS, AUTH_VERIFIER_CACHE_SIZE, AUTH_VERIFIER_TTL
+
+ALGORITHM = "pbkdf2_sha256"
+
+# (stored hash, digest of the secret) => True for verified secrets
+verifier_cache = TTLCache(AUTH_VERIFIER_CACHE_SIZE, AUTH_VERIFIER_TTL)
+
+
+def _bytes(secret):
+    return secret.encode("utf-8") if isinstance(secret, unicode) else secret
+
+
+def secret_digest(secret):
+
+    """
+    Returns cheap digest of the secret, used as cache key so that plain secrets are not kept in memory
+    :param secret: auth id
+    :return: hex digest
+    """
+    return hashlib.sha256(_bytes(secret or "")).hexdigest()
+
+
+def hash_secret(secret, iterations=AUTH_HASH_ITERATIONS, salt=None):
+
+    """
+    Returns salted pbkdf2 hash of the secret
+    :param secret: auth id
+    :param iterations: pbkdf2 iterations
+    :param salt: random salt is used if not given
+    :return: "algorithm$iterations$salt$hash"
+    """
+    salt = salt or binascii.hexlify(os.urandom(16))
+    derived = hashlib.pbkdf2_hmac("sha256", _bytes(secret), salt, iterations)
+    return "%s$%d$%s$%s" % (ALGORITHM, iterations, salt, binascii.hexlify(derived))
+
+
+def verify_plain_secret(secret, plain):
+
+    """
+    Checks secret against a plain text one in constant time, for auth ids stored before they were hashed
+    :param secret: auth id posted by the client
+    :param plain: stored plain text auth id
+    :return: True if secret matches
+    """
+    if not secret or not plain:
+        return False
+
+    return hmac.compare_digest(_bytes(secret), _bytes(plain))
+
+
+def verify_secret(secret, encoded):
+
+    """
+    Checks secret against the stored hash in constant time, successful verifications are cached
+    :param secret: auth id posted by the client
+    :param encoded: hash returned by hash_secret
+    :return: True if secret matches
+    """
+    if not secret or not encoded:
+        return False
+
+    key = (encoded, secret_digest(secret))
+    if verifier_cache.get(key, False):
+        return True
+
+    algorithm, iterations, salt, expected = encoded.split("$")
+    if algorithm != ALGORITHM:
+        return False
+
+    derived = binascii.hexlify(hashlib.pbkdf2_hmac("sha256", _bytes(secret), salt, int(iterations)))
+    verified = hmac.compare_digest(derived, str(expected))
+    if verified:
+        verifier_cache.set(key, True)
+
+    return verified
@@ -0,0 +1,307 @@
+import heapq
+import json
+import os
+import select
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from itertools import izip
+
+from app import db
+from models import phone_number
+from config import NUMBER_DIRECTORY_ENABLED, NUMBER_DIRECTORY_CHANNEL, NUMBER_DIRECTORY_CHUNK_SIZE, \
+    NUMBER_DIRECTORY_MERGE_SIZE, NUMBER_DIRECTORY_RELOAD_INTERVAL
+
+# digits of a number are packed with their count and the leading "+" so that "+49.." and "0049.." stay distinct
+# keys, 16 digits use 54 bits which leaves room for the 6 bits of length and plus in a signed 64 bit integer
+MAX_PACKED_DIGITS = 16
+
+
+def pack_number(number):
+
+    """
+    Returns number packed into a 64 bit integer
+    :param number: phone number
+    :return: integer or None if the number cannot be packed
+    """
+    number = "%s" % number
+    plus = number.startswith("+")
+    digits = number[1:] if plus else number
+    if not digits.isdigit() or len(digits) > MAX_PACKED_DIGITS:
+        return None
+
+    return (int(digits) << 6) | (len(digits) << 1) | int(plus)
+
+
+class NumberDirectory(object):
+
+    """
+    Worker resident directory of all the provisioned numbers, answers "does account X own number N" from memory.
+    Numbers are packed as integers into a sorted array with a parallel array of account ids, 12 bytes per number,
+    so tens of millions of them fit in a few hundred MB. Changes since the last load are kept in a small overlay.
+
+    The directory is loaded by streaming the phone_number table in the background and kept current by the
+    notifications of the phone_number trigger (migration 0005) on postgres, other databases are reloaded every
+    reload_interval seconds. Only ownership is answered from the directory, a number it does not know is looked
+    up in the database as before, so numbers added by other processes are never rejected while their change is
+    on the way
+    """
+
+    def __init__(self, channel, chunk_size, merge_size, reload_interval, enabled=True):
+
+        """
+        :param channel: postgres channel of the phone_number change notifications
+        :param chunk_size: rows fetched and sorted at a time while loading
+        :param merge_size: changes kept in the overlay before the directory is reloaded
+        :param reload_interval: seconds between reloads of databases without notifications
+        :param enabled: lookups always miss if False
+        """
+        self.channel = channel
+        self.chunk_size = chunk_size
+        self.merge_size = merge_size
+        self.reload_interval = reload_interval
+        self.enabled = enabled
+        self.ready = False
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.skipped = 0
+        self.loaded_at = 0
+        # sorted packed numbers and the account owning each of them, "l" items are 64 bit on 64 bit linux
+        self._arrays = (array("l"), array("i"))
+        # packed number => set of account ids added, (packed number, account id) removed since the last load
+        self._added = {}
+        self._removed = set()
+        self._changes = 0
+        # changes received while a load is running, applied on top of the new snapshot
+        self._loading = None
+        # bumped by invalidate, a load which raced with it leaves the directory not ready
+        self._version = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def __len__(self):
+        return len(self._arrays[0])
+
+    def start(self):
+
+        """
+        Starts the loader thread, once per process
+        :return: No return
+        """
+        pid = os.getpid()
+        if not self.enabled or self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid != pid:
+                thread = threading.Thread(target=self._run, name="number-directory")
+                thread.daemon = True
+                thread.start()
+                self._pid = pid
+
+    def contains(self, account_id, number):
+
+        """
+        Checks if the directory knows that the number belongs to the account
+        :param account_id: account id
+        :param number: phone number
+        :return: True if number belongs to the account, False if it is unknown and has to be looked up
+        """
+        if not self.ready:
+            self.start()
+            return False
+
+        key = pack_number(number)
+        if key is not None and (key, account_id) not in self._removed:
+            if account_id in self._added.get(key, ()):
+                self.hits += 1
+                return True
+
+            keys, accounts = self._arrays
+            position = bisect_left(keys, key)
+            while position < len(keys) and keys[position] == key:
+                if accounts[position] == account_id:
+                    self.hits += 1
+                    return True
+                position += 1
+
+        self.misses += 1
+        return False
+
+    def add(self, account_id, number):
+        self._change(True, account_id, number)
+
+    def discard(self, account_id, number):
+        self._change(False, account_id, number)
+
+    def _change(self, added, account_id, number):
+
+        """
+        Applies a committed change to the overlay
+        :param added: True if the number was added to the account else False
+        :param account_id: account id
+        :param number: phone number
+        :return: No return
+        """
+        key = pack_number(number)
+        if key is None:
+            return
+
+        with self._lock:
+            if self._loading is not None:
+                self._loading.append((added, key, account_id))
+            self._apply(added, key, account_id)
+
+    def _apply(self, added, key, account_id):
+        if added:
+            self._removed.discard((key, account_id))
+            self._added.setdefault(key, set()).add(account_id)
+        else:
+            accounts = self._added.get(key)
+            if accounts is not None:
+                accounts.discard(account_id)
+            self._removed.add((key, account_id))
+        self._changes += 1
+
+    def load(self):
+
+        """
+        Replaces the directory with the numbers in the database, rows are streamed and sorted in chunks
+        which are merged at the end, so only the arrays are held in memory
+        :return: No return
+        """
+        version = self._version
+        with self._lock:
+            self._loading = []
+
+        try:
+            arrays = self._read()
+        except Exception:
+            with self._lock:
+                self._loading = None
+            raise
+
+        with self._lock:
+            changes, self._loading = self._loading, None
+            self._arrays = arrays
+            self._added, self._removed, self._changes = {}, set(), 0
+            for change in changes:
+                self._apply(*change)
+            self.ready = self.enabled and self._version == version
+            self.loaded_at = time.time()
+            self.loads += 1
+
+    def _read(self):
+
+        """
+        :return: tuple of sorted packed numbers and parallel account ids
+        """
+        numbers = phone_number.__table__
+        chunks = []
+        skipped = 0
+        with db.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(
+                db.select([numbers.c.number, numbers.c.account_id]))
+            while True:
+                rows = result.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+
+                packed = []
+                for number, account_id in rows:
+                    key = pack_number(number)
+                    if key is None:
+                        skipped += 1
+                    else:
+                        packed.append((key, account_id))
+                packed.sort()
+                chunks.append((array("l", [key for key, account_id in packed]),
+                               array("i", [account_id for key, account_id in packed])))
+
+        keys, accounts = array("l"), array("i")
+        for key, account_id in heapq.merge(*[izip(*chunk) for chunk in chunks]):
+            keys.append(key)
+            accounts.append(account_id)
+
+        self.skipped = skipped
+        return keys, accounts
+
+    def invalidate(self):
+
+        """
+        Misses every lookup till the directory is reloaded, e.g. after numbers were changed in bulk
+        :return: No return
+        """
+        self._version += 1
+        self.ready = False
+
+    def stats(self):
+        return dict(numbers=len(self), changes=self._changes, skipped=self.skipped, loads=self.loads,
+                    ready=int(self.ready))
+
+    def _listen(self):
+
+        """
+        Subscribes to the change notifications if the database supports them
+        :return: detached raw connection or None
+        """
+        if db.engine.dialect.name != "postgresql":
+            return None
+
+        connection = db.engine.raw_connection()
+        # the connection stays in autocommit mode, keep it out of the pool
+        connection.detach()
+        connection.connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute("LISTEN %s" % self.channel)
+        cursor.close()
+        return connection
+
+    def _receive(self, connection, timeout):
+
+        """
+        Applies notifications which arrive within timeout seconds
+        :param connection: raw connection listening to the channel or None
+        :param timeout: seconds to wait
+        :return: No return
+        """
+        if connection is None:
+            time.sleep(timeout)
+            return
+
+        dbapi_connection = connection.connection
+        if select.select([dbapi_connection], [], [], timeout) == ([], [], []):
+            return
+
+        dbapi_connection.poll()
+        while dbapi_connection.notifies:
+            notify = dbapi_connection.notifies.pop(0)
+            operation, account_id, number = json.loads(notify.payload)
+            self._change(operation == "+", account_id, number)
+
+    def _run(self):
+        while True:
+            connection = None
+            try:
+                # listen before loading so that no change is missed in between
+                connection = self._listen()
+                self.load()
+                while True:
+                    self._receive(connection, 1.0)
+                    if not self.ready or self._changes >= self.merge_size or \
+                            (connection is None and time.time() - self.loaded_at >= self.reload_interval):
+                        self.load()
+            except Exception as e:
+                print e
+            finally:
+                if connection is not None:
+                    connection.close()
+
+            time.sleep(1)
+
+
+number_directory = NumberDirectory(NUMBER_DIRECTORY_CHANNEL, NUMBER_DIRECTORY_CHUNK_SIZE,
+                                   NUMBER_DIRECTORY_MERGE_SIZE, NUMBER_DIRECTORY_RELOAD_INTERVAL,
+                                   enabled=NUMBER_DIRECTORY_ENABLED)
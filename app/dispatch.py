@@ -0,0 +1,264 @@
+import threading
+import time
+import uuid
+from importlib import import_module
+
+import redis
+
+from utils import get_redis_connection, redis_breaker, count_fallback
+from config import DISPATCH_STREAM, DISPATCH_DEAD_LETTER_STREAM, DISPATCH_GROUP, DISPATCH_MAX_BACKLOG, \
+    DISPATCH_BATCH_SIZE, DISPATCH_MAX_RETRIES, DISPATCH_RETRY_AFTER, DISPATCH_HANDLER, DISPATCH_LOCAL_BACKLOG
+
+# Appends the message to the stream unless the backlog is full.
+# KEYS[1] => stream, ARGV[1] => maximum backlog, ARGV[2..] => field, value pairs of the message
+# returns id of the message or false if backlog is full
+ENQUEUE_SCRIPT = """
+if redis.call('XLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+    return false
+end
+return redis.call('XADD', KEYS[1], '*', unpack(ARGV, 2))
+"""
+
+enqueue_script = redis.StrictRedis().register_script(ENQUEUE_SCRIPT)
+
+QUEUE_FULL_ERROR = "outbound queue is full, retry later"
+
+# smses accepted while redis was unavailable, queued once it is back
+local_backlog = []
+_backlog_lock = threading.Lock()
+
+
+def message_fields(account_id, from_number, to_number, text):
+    return ["account_id", account_id, "from", from_number, "to", to_number, "text", text, "ts", time.time()]
+
+
+def buffer_outbound(account_id, from_number, to_number, text):
+
+    """
+    Keeps accepted sms in process while redis is unavailable
+    :return: error statement if the local backlog is full else None
+    """
+    with _backlog_lock:
+        if len(local_backlog) >= DISPATCH_LOCAL_BACKLOG:
+            return QUEUE_FULL_ERROR
+        local_backlog.append((account_id, from_number, to_number, text))
+
+    return None
+
+
+def buffer_outbound_batch(messages):
+    return [buffer_outbound(*message) for message in messages]
+
+
+def flush_local_backlog():
+
+    """
+    Queues smses accepted while redis was unavailable
+    :return: No return
+    """
+    with _backlog_lock:
+        messages = local_backlog[:]
+        del local_backlog[:]
+
+    for start in range(0, len(messages), DISPATCH_BATCH_SIZE):
+        errors = enqueue_outbound_batch(messages[start:start + DISPATCH_BATCH_SIZE])
+        dropped = len([error for error in errors if error])
+        if dropped:
+            print "dropped %d buffered smses, outbound queue is full" % dropped
+
+
+redis_breaker.on_recover.append(flush_local_backlog)
+
+
+@redis_breaker.fallback(buffer_outbound, count_fallback)
+def enqueue_outbound(account_id, from_number, to_number, text):
+
+    """
+    Queues accepted sms for delivery
+    :param account_id: account sending the sms
+    :param from_number: number sending the sms
+    :param to_number: recipient
+    :param text: sms text
+    :return: error statement if the queue is full else None
+    """
+    message_id = enqueue_script(keys=[DISPATCH_STREAM],
+                                args=[DISPATCH_MAX_BACKLOG] + message_fields(account_id, from_number, to_number, text),
+                                client=get_redis_connection(DISPATCH_STREAM))
+    if not message_id:
+        return QUEUE_FULL_ERROR
+
+    return None
+
+
+@redis_breaker.fallback(buffer_outbound_batch, count_fallback)
+def enqueue_outbound_batch(messages):
+
+    """
+    Batch version of enqueue_outbound, all the smses are queued in a single pipelined round trip
+    :param messages: list of (account_id, from_number, to_number, text) tuples
+    :return: list with error statement for every sms which could not be queued otherwise None
+    """
+    if not messages:
+        return []
+
+    pipe = get_redis_connection(DISPATCH_STREAM).pipeline(transaction=False)
+    for message in messages:
+        enqueue_script(keys=[DISPATCH_STREAM], args=[DISPATCH_MAX_BACKLOG] + message_fields(*message), client=pipe)
+
+    return [None if message_id else QUEUE_FULL_ERROR for message_id in pipe.execute()]
+
+
+def print_delivery(messages):
+
+    """
+    Default delivery handler, prints the messages
+    :param messages: list of (message id, fields) tuples
+    :return: list of ids of the messages which could not be delivered
+    """
+    for message_id, fields in messages:
+        print "delivering sms %s from %s to %s" % (message_id, fields["from"], fields["to"])
+
+    return []
+
+
+def load_handler(path):
+
+    """
+    Returns delivery handler
+    :param path: dotted path of the function e.g. "app.dispatch.print_delivery"
+    :return: function
+    """
+    module, name = path.rsplit(".", 1)
+    return getattr(import_module(module), name)
+
+
+class DispatchWorker(threading.Thread):
+
+    """
+    Drains the outbound stream in batches as a member of the consumer group.
+    Messages which could not be delivered stay pending and are retried after DISPATCH_RETRY_AFTER seconds,
+    after DISPATCH_MAX_RETRIES deliveries they are moved to the dead letter stream
+    """
+
+    def __init__(self, handler, stopped, name=None):
+
+        """
+        :param handler: function delivering list of (message id, fields), returns ids of failed messages
+        :param stopped: threading.Event, worker exits once it is set
+        :param name: consumer name, unique per worker
+        """
+        super(DispatchWorker, self).__init__(name=name or "dispatcher-%s" % uuid.uuid4().hex[:8])
+        self.daemon = True
+        self.handler = handler
+        self.stopped = stopped
+        self.delivered = 0
+        self.failed = 0
+        self.dead_lettered = 0
+
+    def run(self):
+        redis_conn = get_redis_connection(DISPATCH_STREAM)
+        create_group(redis_conn)
+        last_reclaim = 0
+
+        while not self.stopped.is_set():
+            try:
+                if time.time() - last_reclaim >= DISPATCH_RETRY_AFTER:
+                    self.reclaim(redis_conn)
+                    last_reclaim = time.time()
+
+                response = redis_conn.xreadgroup(DISPATCH_GROUP, self.name, {DISPATCH_STREAM: ">"},
+                                                 count=DISPATCH_BATCH_SIZE, block=100)
+                for stream, messages in response:
+                    self.deliver(redis_conn, messages)
+            except Exception as e:
+                print e
+                time.sleep(1)
+
+    def deliver(self, redis_conn, messages):
+
+        """
+        Hands over messages to the handler and acknowledges delivered ones
+        :param redis_conn: redis connection
+        :param messages: list of (message id, fields) tuples
+        :return: No return
+        """
+        try:
+            failed = set(self.handler(messages))
+        except Exception as e:
+            print e
+            failed = set(message_id for message_id, fields in messages)
+
+        delivered = [message_id for message_id, fields in messages if message_id not in failed]
+        if delivered:
+            redis_conn.pipeline().xack(DISPATCH_STREAM, DISPATCH_GROUP, *delivered) \
+                .xdel(DISPATCH_STREAM, *delivered).execute()
+
+        self.delivered += len(delivered)
+        self.failed += len(failed)
+
+    def reclaim(self, redis_conn):
+
+        """
+        Claims messages which stayed unacknowledged for DISPATCH_RETRY_AFTER seconds and retries them,
+        messages delivered DISPATCH_MAX_RETRIES times are moved to the dead letter stream
+        :param redis_conn: redis connection
+        :return: No return
+        """
+        pending = redis_conn.xpending_range(DISPATCH_STREAM, DISPATCH_GROUP, "-", "+", DISPATCH_BATCH_SIZE)
+        idle = DISPATCH_RETRY_AFTER * 1000
+        pending = [entry for entry in pending if entry["time_since_delivered"] >= idle]
+        if not pending:
+            return
+
+        dead = set(entry["message_id"] for entry in pending if entry["times_delivered"] >= DISPATCH_MAX_RETRIES)
+        claimed = redis_conn.xclaim(DISPATCH_STREAM, DISPATCH_GROUP, self.name, idle,
+                                    [entry["message_id"] for entry in pending])
+
+        retry = []
+        pipe = redis_conn.pipeline()
+        for message_id, fields in claimed:
+            if message_id in dead and fields:
+                pipe.xadd(DISPATCH_DEAD_LETTER_STREAM, fields)
+                self.dead_lettered += 1
+            elif fields:
+                retry.append((message_id, fields))
+                continue
+
+            # dead lettered or deleted meanwhile
+            pipe.xack(DISPATCH_STREAM, DISPATCH_GROUP, message_id)
+            pipe.xdel(DISPATCH_STREAM, message_id)
+        pipe.execute()
+
+        if retry:
+            self.deliver(redis_conn, retry)
+
+
+def create_group(redis_conn):
+
+    """
+    Creates the consumer group along with the stream if they do not exist
+    :param redis_conn: redis connection
+    :return: No return
+    """
+    try:
+        redis_conn.xgroup_create(DISPATCH_STREAM, DISPATCH_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def start_workers(count, handler=None):
+
+    """
+    Starts dispatch workers
+    :param count: number of worker threads
+    :param handler: delivery handler, DISPATCH_HANDLER is used if not given
+    :return: tuple of workers and the event which stops them
+    """
+    handler = handler or load_handler(DISPATCH_HANDLER)
+    stopped = threading.Event()
+    workers = [DispatchWorker(handler, stopped) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+
+    return workers, stopped
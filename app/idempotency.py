@@ -0,0 +1,182 @@
+import functools
+import hashlib
+import json
+import time
+
+from flask import g, request, jsonify, Response
+from werkzeug import exceptions
+
+from utils import get_redis_connection, redis_breaker, count_fallback
+from breaker import UNAVAILABLE_ERROR
+from dispatch import QUEUE_FULL_ERROR
+from message import request_data
+from metrics import idempotent_requests_total
+from config import IDEMPOTENCY_TTL, IDEMPOTENCY_PENDING_TTL, IDEMPOTENCY_WAIT, IDEMPOTENCY_POLL_INTERVAL, \
+    IDEMPOTENCY_MAX_POLL_INTERVAL
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_PREFIX = "IDEMPOTENCY_"
+
+# responses which are not stored so that the retry executes the request again, so are the ones asking
+# the client to retry after some time like "limit reached for from ..."
+TRANSIENT_ERRORS = ("unknown failure", QUEUE_FULL_ERROR, UNAVAILABLE_ERROR)
+
+
+def utf8(value):
+    # credentials and header values may be unicode, hashlib takes bytes only
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return "%s" % value
+
+
+def idempotency_key(endpoint, key):
+
+    """
+    Returns redis key of the stored response, scoped by endpoint and credentials so that
+    different accounts never share responses
+    :param endpoint: endpoint name
+    :param key: value of the Idempotency-Key header
+    :return: redis key
+    """
+    data = request_data(request)
+    scope = hashlib.sha256(":".join(utf8(value) for value in (data.get("username"), data.get("password"), key)))
+    return "%s%s:%s" % (IDEMPOTENCY_PREFIX, endpoint, scope.hexdigest())
+
+
+def request_fingerprint():
+
+    """
+    Returns digest of the request body, a key reused for a different request is rejected
+    :return: hex digest
+    """
+    form = sorted(request.form.lists())
+    digest = hashlib.sha256(json.dumps([request.path, form]))
+    # raw body may not be valid utf-8, so it is not passed through json
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def replay(stored):
+
+    """
+    Rebuilds stored response
+    :param stored: dict with status, headers, body and error
+    :return: response
+    """
+    g.error = stored.get("error")
+    response = Response(stored["body"], status=stored["status"], headers=stored["headers"])
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def skip(*args):
+    return None
+
+
+@redis_breaker.fallback(lambda redis_conn, key, fingerprint: (None, None), count_fallback)
+def claim(redis_conn, key, fingerprint):
+
+    """
+    Claims the key for this request unless another request claimed it first
+    :return: tuple of True if claimed and the stored value of the other request,
+             (None, None) if redis is unavailable and the request is executed without deduplication
+    """
+    if redis_conn.set(key, json.dumps(dict(fingerprint=fingerprint)), nx=True, ex=IDEMPOTENCY_PENDING_TTL):
+        return True, None
+
+    stored = redis_conn.get(key)
+    return False, json.loads(stored) if stored else None
+
+
+@redis_breaker.fallback(skip, count_fallback)
+def release(redis_conn, key):
+    redis_conn.delete(key)
+
+
+@redis_breaker.fallback(skip, count_fallback)
+def store(redis_conn, key, fingerprint, response):
+
+    """
+    Stores the response for IDEMPOTENCY_TTL seconds, transient and retryable failures are dropped
+    :return: No return
+    """
+    error = g.get("error")
+    if response.status_code >= 500 or error in TRANSIENT_ERRORS or "Retry-After" in response.headers:
+        redis_conn.delete(key)
+        return
+
+    headers = [(name, value) for name, value in response.headers.items() if name != "Content-Length"]
+    redis_conn.set(key, json.dumps(dict(fingerprint=fingerprint, status=response.status_code, headers=headers,
+                                        body=response.get_data(), error=error)), ex=IDEMPOTENCY_TTL)
+
+
+def conflict(error, status):
+    g.error = error
+    response = jsonify(error=error, message="")
+    response.status_code = status
+    return response
+
+
+def idempotent(endpoint):
+
+    """
+    Executes the view once per Idempotency-Key header, duplicates are answered from redis without
+    authentication, quota or any other work. Concurrent duplicates wait for the first request to finish.
+    Requests are executed without deduplication while redis is unavailable
+    :param endpoint: endpoint name, keys are not shared across endpoints
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            header = request.headers.get(IDEMPOTENCY_HEADER)
+            if not header:
+                return view(*args, **kwargs)
+
+            key = idempotency_key(endpoint, header)
+            fingerprint = request_fingerprint()
+            redis_conn = get_redis_connection(key)
+            deadline = time.time() + IDEMPOTENCY_WAIT
+            delay = IDEMPOTENCY_POLL_INTERVAL
+
+            while True:
+                # deduplication is skipped while redis is unavailable
+                claimed, stored = claim(redis_conn, key, fingerprint)
+                if claimed is None:
+                    idempotent_requests_total.inc((endpoint, "unavailable"))
+                    return view(*args, **kwargs)
+
+                # first request claims the key and executes the view
+                if claimed:
+                    idempotent_requests_total.inc((endpoint, "executed"))
+                    try:
+                        response = view(*args, **kwargs)
+                    except exceptions.HTTPException:
+                        release(redis_conn, key)
+                        raise
+                    try:
+                        store(redis_conn, key, fingerprint, response)
+                    except Exception as e:
+                        # the request has been executed, a retry finds the pending marker till it expires
+                        print e
+                    return response
+
+                if stored:
+                    if stored["fingerprint"] != fingerprint:
+                        idempotent_requests_total.inc((endpoint, "conflict"))
+                        error = "%s was used for a different request" % IDEMPOTENCY_HEADER
+                        return conflict(error, 422)
+                    if "body" in stored:
+                        idempotent_requests_total.inc((endpoint, "replayed"))
+                        return replay(stored)
+
+                # duplicate of a request still in flight
+                if time.time() >= deadline:
+                    idempotent_requests_total.inc((endpoint, "in_progress"))
+                    error = "request with the same %s is in progress, retry later" % IDEMPOTENCY_HEADER
+                    return conflict(error, 409)
+                # back off while the first request is executing
+                time.sleep(min(delay, max(deadline - time.time(), 0)))
+                delay = min(delay * 2, IDEMPOTENCY_MAX_POLL_INTERVAL)
+
+        return wrapper
+    return decorator
@@ -0,0 +1,83 @@
+import time
+
+from app import db
+from models import Account, phone_number
+from utils import reset_redis_connection, limiter_cache, number_cache, stop_cache, stop_store
+from quota import quota_policies
+from directory import number_directory
+from accounting import usage_recorder
+from config import DEFAULT_RATE_LIMITER, SERVER_WARMUP_TIMEOUT
+
+
+def after_fork():
+
+    """
+    Drops database and redis connections inherited from the parent, the worker opens its own on first use
+    :return: No return
+    """
+    db.engine.dispose()
+    reset_redis_connection()
+
+
+def warm_caches(timeout=SERVER_WARMUP_TIMEOUT):
+
+    """
+    Fills the caches of a new worker before it accepts requests, so that a deploy does not send every first
+    request to postgres. Account lookups are keyed by the auth id, which is only stored hashed, so they cannot
+    be filled ahead and stay lazy. Warm up is best effort, a step which fails is logged and the worker starts with
+    that cache cold rather than failing to boot
+    :param timeout: seconds to wait for the number directory and the stop request filter
+    :return: dict of entries loaded per cache, the stop request restore report and seconds taken
+    """
+    started = time.time()
+
+    # stop requests are restored if redis lost them, before the filter is built from redis
+    stop_store.start()
+    restore = None
+    for name, step in [("quota", quota_policies.load), ("limiter", warm_limiters), ("number", warm_numbers),
+                       ("stop_restore", stop_store.restore)]:
+        try:
+            result = step()
+            if name == "stop_restore":
+                restore = result
+        except Exception as e:
+            print "warming %s failed, starting with it cold: %s" % (name, e)
+        finally:
+            db.session.remove()
+
+    # load the number directory, subscribe to stop requests and build the filter
+    number_directory.start()
+    stop_cache.start()
+    while time.time() - started < timeout and ((number_directory.enabled and not number_directory.ready) or
+                                               (stop_cache.enabled and not stop_cache.filter_ready)):
+        time.sleep(0.05)
+
+    return dict(limiter=len(limiter_cache), number=len(number_cache), directory=len(number_directory),
+                stop_filter=int(stop_cache.filter_ready), stop_restore=restore, seconds=time.time() - started)
+
+
+def warm_limiters():
+    rows = db.session.query(Account.id, Account.rate_limiter).limit(limiter_cache.maxsize)
+    for account_id, rate_limiter in rows:
+        limiter_cache.set(account_id, rate_limiter or DEFAULT_RATE_LIMITER)
+
+
+def warm_numbers():
+    # ownership is answered by the number directory, the cache is filled only for workers running without it
+    if not number_directory.enabled:
+        rows = db.session.query(phone_number.account_id, phone_number.number).limit(number_cache.maxsize)
+        for account_id, number in rows:
+            number_cache.set((account_id, "%s" % number), True)
+
+
+def before_exit():
+
+    """
+    Writes usage counted and stop requests received by the worker before it exits
+    :return: No return
+    """
+    for store in (usage_recorder, stop_store):
+        try:
+            store.flush()
+        except Exception as e:
+            print e
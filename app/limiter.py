@@ -0,0 +1,398 @@
+import threading
+import time
+from collections import namedtuple
+
+import redis
+
+# allowed => number of requested smses allowed, blocked => True if recipient has registered stop request for sender,
+# remaining => smses left in the quota, reset => seconds after which the quota is fully available again,
+# retry_after => seconds after which a rejected sms can be retried
+LimitResult = namedtuple('LimitResult', ['allowed', 'blocked', 'limit', 'remaining', 'reset', 'retry_after'])
+
+# Common prologue of all the limiter scripts.
+# Optionally checks if the recipients of smses have registered stop request for the sender, quota is not touched for
+# blocked smses.
+# KEYS[1..n] => limiter keys, KEYS[n+1..] => stop key of every sms which is checked for a stop request
+# ARGV[1] => number of limiter keys n, ARGV[2] => smses requested without stop check, ARGV[3] => limit,
+# ARGV[4] => window in seconds, ARGV[5] => current unix time, ARGV[6..] => from number of every checked sms
+# every script returns {allowed, remaining, reset, retry_after, blocked}, blocked has a "1" for every checked sms
+# which is blocked and a "0" otherwise, allowed is -1 if all the smses are blocked
+SCRIPT_PROLOGUE = """
+local nkeys = tonumber(ARGV[1])
+local requested = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local window = tonumber(ARGV[4])
+local now = tonumber(ARGV[5])
+local blocked = ''
+for i = nkeys + 1, #KEYS do
+    if redis.call('GET', KEYS[i]) == ARGV[i - nkeys + 5] then
+        blocked = blocked .. '1'
+    else
+        blocked = blocked .. '0'
+        requested = requested + 1
+    end
+end
+if requested == 0 and #KEYS > nkeys then
+    return {-1, 0, 0, 0, blocked}
+end
+"""
+
+
+class Limiter(object):
+
+    """
+    Base class of rate limiting strategies. Quota is checked and updated by a single atomic script per key
+    """
+
+    name = None
+    script = None
+    # gives back smses which were granted but not sent, KEYS[1] => counter of the current window,
+    # ARGV[1] => smses to give back, ARGV[2] => limit
+    refund_script = """
+local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+local refunded = math.min(count, tonumber(ARGV[1]))
+if refunded > 0 then
+    redis.call('DECRBY', KEYS[1], refunded)
+end
+return refunded
+"""
+
+    def __init__(self):
+        self._script = redis.StrictRedis().register_script(SCRIPT_PROLOGUE + self.script)
+        self._refund_script = redis.StrictRedis().register_script(self.refund_script)
+
+    def keys(self, key, window, now):
+
+        """
+        Returns redis keys used by the strategy
+        :param key: usage key
+        :param window: window in seconds
+        :param now: current unix time
+        :return: list of keys
+        """
+        return [key]
+
+    def call(self, client, key, limit, window, count=1, stops=()):
+
+        """
+        Invokes the script, on a pipeline the call is only queued and the result is parsed by result()
+        :param client: redis connection or pipeline
+        :param key: usage key
+        :param limit: maximum number of smses allowed in the window
+        :param window: window in seconds
+        :param count: number of smses to be sent without stop check
+        :param stops: list of (stop key, from number) of further smses which are sent only if the recipient has
+                      no stop request for the sender, stop keys must live on the node of the usage key
+        :return: raw script result
+        """
+        now = time.time()
+        keys = self.keys(key, window, now)
+        return self._script(keys=keys + [stop_key for stop_key, from_number in stops],
+                            args=[len(keys), count, limit, window, now] +
+                                 [from_number for stop_key, from_number in stops],
+                            client=client)
+
+    @staticmethod
+    def result(raw, limit):
+
+        """
+        Converts raw script result to LimitResult
+        :param raw: script result
+        :param limit: maximum number of smses allowed in the window
+        :return: LimitResult
+        """
+        allowed, remaining, reset, retry_after = [int(value) for value in raw[:4]]
+        if allowed == -1:
+            return Limiter.blocked(limit)
+
+        return LimitResult(allowed, False, limit, remaining, reset, retry_after)
+
+    @staticmethod
+    def blocked(limit):
+
+        """
+        Returns result of an sms blocked by stop request
+        :param limit: maximum number of smses allowed in the window
+        :return: LimitResult
+        """
+        return LimitResult(0, True, limit, 0, 0, 0)
+
+    def hit(self, client, key, limit, window, count=1):
+
+        """
+        Checks quota and consumes as many of the requested smses as the limit permits
+        :return: LimitResult
+        """
+        return self.result(self.call(client, key, limit, window, count), limit)
+
+    def hit_each(self, client, key, limit, window, stops):
+
+        """
+        Checks quota of many single smses by one script call, every sms with a stop key is checked against its stop
+        request first and blocked ones take no quota. Smses are allowed in the given order
+        :param client: redis connection
+        :param key: usage key
+        :param limit: maximum number of smses allowed in the window
+        :param window: window in seconds
+        :param stops: (stop key, from number) for every sms, None for smses without stop check
+        :return: list of LimitResult, one per sms
+        """
+        checked = [stop for stop in stops if stop is not None]
+        raw = self.call(client, key, limit, window, len(stops) - len(checked), checked)
+        result = self.result(raw, limit)
+        flags = iter(raw[4])
+
+        results = []
+        position = 0
+        for stop in stops:
+            if stop is not None and next(flags) == "1":
+                results.append(self.blocked(limit))
+            elif position < result.allowed:
+                results.append(result._replace(allowed=1, remaining=result.remaining + result.allowed - position - 1,
+                                               retry_after=0))
+                position += 1
+            else:
+                results.append(result._replace(allowed=0))
+                position += 1
+
+        return results
+
+    def refund(self, client, key, limit, window, count=1):
+
+        """
+        Gives back smses consumed by hit which were not sent after all, e.g. because the queue was full
+        :param client: redis connection
+        :param key: usage key
+        :param limit: maximum number of smses allowed in the window
+        :param window: window in seconds
+        :param count: number of smses to give back
+        :return: number of smses given back
+        """
+        keys = self.keys(key, window, time.time())[:1]
+        return int(self._refund_script(keys=keys, args=[count, limit], client=client))
+
+
+class FixedWindowLimiter(Limiter):
+
+    """
+    Counts smses in a window starting with the first sms, counter is reset when the window expires.
+    A sender can burst twice the limit across the window boundary
+    """
+
+    name = "fixed_window"
+    script = """
+local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+local allowed = math.min(requested, math.max(limit - count, 0))
+if allowed > 0 then
+    count = redis.call('INCRBY', KEYS[1], allowed)
+    if count == allowed then
+        redis.call('EXPIRE', KEYS[1], window)
+    end
+end
+local ttl = math.max(redis.call('TTL', KEYS[1]), 0)
+local retry = 0
+if allowed < requested then
+    retry = ttl
+end
+return {allowed, math.max(limit - count, 0), ttl, retry, blocked}
+"""
+
+
+class SlidingWindowLimiter(Limiter):
+
+    """
+    Sliding window counter, usage of the previous window is weighted by its overlap with the sliding window.
+    Needs two counters per sender
+    """
+
+    name = "sliding_window"
+    script = """
+local elapsed = now % window
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+local weight = (window - elapsed) / window
+local estimate = previous * weight + current
+local allowed = math.min(requested, math.max(math.floor(limit - estimate), 0))
+if allowed > 0 then
+    current = redis.call('INCRBY', KEYS[1], allowed)
+    if current == allowed then
+        redis.call('EXPIRE', KEYS[1], window * 2)
+    end
+    estimate = estimate + allowed
+end
+local reset = math.ceil(window - elapsed)
+if current > 0 then
+    reset = reset + window
+end
+local retry = 0
+if allowed < requested then
+    local excess = estimate + 1 - limit
+    if previous > 0 and excess <= previous * weight then
+        retry = math.ceil(excess * window / previous)
+    else
+        retry = math.ceil(window - elapsed)
+    end
+end
+return {allowed, math.max(math.floor(limit - estimate), 0), reset, retry, blocked}
+"""
+
+    def keys(self, key, window, now):
+        # hash tag keeps both the counters on the node owning the usage key
+        index = int(now // window)
+        return ["{%s}:%d" % (key, index), "{%s}:%d" % (key, index - 1)]
+
+
+class TokenBucketLimiter(Limiter):
+
+    """
+    Bucket holds upto limit tokens and is refilled at limit per window, every sms takes a token.
+    Allows short bursts while keeping the long term rate
+    """
+
+    name = "token_bucket"
+    script = """
+local rate = limit / window
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or limit
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(limit, tokens + math.max(now - ts, 0) * rate)
+local allowed = math.min(requested, math.max(math.floor(tokens), 0))
+tokens = tokens - allowed
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(window))
+local retry = 0
+if allowed < requested then
+    retry = math.ceil((1 - tokens) / rate)
+end
+return {allowed, math.floor(tokens), math.ceil((limit - tokens) / rate), retry, blocked}
+"""
+
+    refund_script = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+if not tokens then
+    return 0
+end
+local refunded = math.min(tonumber(ARGV[1]), tonumber(ARGV[2]) - tokens)
+if refunded > 0 then
+    redis.call('HSET', KEYS[1], 'tokens', tokens + refunded)
+    return math.floor(refunded)
+end
+return 0
+"""
+
+    def keys(self, key, window, now):
+        return ["{%s}:bucket" % key]
+
+
+LIMITERS = dict((limiter.name, limiter) for limiter in [FixedWindowLimiter(), SlidingWindowLimiter(),
+                                                       TokenBucketLimiter()])
+
+
+def get_limiter(name):
+
+    """
+    Returns limiter for the strategy name
+    :param name: one of the LIMITERS keys
+    :return: limiter
+    """
+    try:
+        return LIMITERS[name]
+    except KeyError:
+        raise ValueError("unknown rate limiter %s" % name)
+
+
+def hit_many(client, hits):
+
+    """
+    Checks and updates quota of many keys in a single pipelined round trip, every key is updated atomically
+    :param client: redis connection
+    :param hits: list of (limiter, key, limit, window, count) tuples
+    :return: list of LimitResult in the same order
+    """
+    pipe = client.pipeline(transaction=False)
+    for limiter, key, limit, window, count in hits:
+        limiter.call(pipe, key, limit, window, count)
+
+    return [Limiter.result(raw, hit[2]) for hit, raw in zip(hits, pipe.execute())]
+
+
+class LocalLimiter(object):
+
+    """
+    In process fixed window approximation of the limiters used while redis is unavailable. Every process
+    grants share of the limit on its own, usage granted is kept so that it can be added to redis once it is back
+    """
+
+    def __init__(self, share=1.0, maxsize=100000):
+
+        """
+        :param share: fraction of the limit granted by this process
+        :param maxsize: expired windows are dropped once more keys are tracked
+        """
+        self.share = share
+        self.maxsize = maxsize
+        # key => [window end, used]
+        self._windows = {}
+        # (strategy, key, limit, window) => smses granted locally
+        self._granted = {}
+        self._lock = threading.Lock()
+
+    def hit(self, strategy, key, limit, window, count=1):
+
+        """
+        :return: LimitResult
+        """
+        now = time.time()
+        local_limit = max(int(limit * self.share), 1)
+        with self._lock:
+            if len(self._windows) >= self.maxsize:
+                self._windows = dict((k, v) for k, v in self._windows.items() if v[0] > now)
+
+            entry = self._windows.get(key)
+            if entry is None or entry[0] <= now:
+                entry = self._windows[key] = [now + window, 0]
+
+            allowed = max(min(count, local_limit - entry[1]), 0)
+            entry[1] += allowed
+            if allowed:
+                granted_key = (strategy, key, limit, window)
+                self._granted[granted_key] = self._granted.get(granted_key, 0) + allowed
+
+        reset = int(entry[0] - now) + 1
+        return LimitResult(allowed, False, limit, local_limit - entry[1], reset, reset if allowed < count else 0)
+
+    def refund(self, strategy, key, limit, window, count=1):
+
+        """
+        Gives back smses granted locally which were not sent after all
+        :return: No return
+        """
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is not None:
+                entry[1] = max(entry[1] - count, 0)
+            granted_key = (strategy, key, limit, window)
+            if granted_key in self._granted:
+                self._granted[granted_key] = max(self._granted[granted_key] - count, 0)
+
+    def drain(self):
+
+        """
+        Returns and forgets usage granted locally
+        :return: dict of (strategy, key, limit, window) => smses granted
+        """
+        with self._lock:
+            granted, self._granted = self._granted, {}
+            self._windows = {}
+        return granted
+
+    def restore(self, granted):
+
+        """
+        Puts back usage which could not be added to redis
+        :param granted: dict returned by drain
+        :return: No return
+        """
+        with self._lock:
+            for key, count in granted.items():
+                self._granted[key] = self._granted.get(key, 0) + count
@@ -0,0 +1,108 @@
+import re
+
+from metrics import stage_seconds
+
+# separators dropped from the numbers, "+91 99164-25256" is stored and looked up as "+919916425256"
+NUMBER_SEPARATORS = re.compile(r"[\s().-]")
+# optional + followed by digits, 6 to 16 characters in total
+NUMBER_PATTERN = re.compile(r"^(?=.{6,16}$)\+?[0-9]+$")
+
+MISSING_ERROR = "parameter '%s' is missing"
+INVALID_ERROR = "parameter '%s' is invalid"
+
+
+def normalize_number(number):
+    return NUMBER_SEPARATORS.sub("", number)
+
+
+def valid_number(number):
+    return NUMBER_PATTERN.match(number) is not None
+
+
+def valid_text(text):
+    return 1 <= len(text) <= 120
+
+
+# parameter, attribute, normalization and check of every mandatory parameter. when several parameters are wrong
+# the error of the last one is reported, so they are checked in reverse
+RULES = (
+    ("text", "text", None, valid_text),
+    ("to", "to_number", normalize_number, valid_number),
+    ("from", "from_number", normalize_number, valid_number),
+)
+
+
+class SmsMessage(object):
+
+    """
+    Parsed and validated sms, passed through authentication, STOP and quota checks
+    """
+
+    __slots__ = ("from_number", "to_number", "text", "username", "password")
+
+    def __init__(self, from_number, to_number, text, username=None, password=None):
+        self.from_number = from_number
+        self.to_number = to_number
+        self.text = text
+        self.username = username
+        self.password = password
+
+    @property
+    def credentials(self):
+        return self.username, self.password
+
+
+def request_data(request):
+
+    """
+    Returns parameters of the request, json objects are accepted alongside form encoding
+    :param request: incoming request
+    :return: dict like object
+    """
+    if request.mimetype == "application/json":
+        data = request.get_json(silent=True)
+        return data if isinstance(data, dict) else {}
+
+    return request.form
+
+
+def get_parameter(data, name):
+
+    """
+    Returns parameter as string, json numbers are accepted for the phone numbers
+    """
+    value = data.get(name)
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return str(value)
+    if isinstance(value, basestring):
+        return value
+    return None if value in (None, "") else value
+
+
+@stage_seconds.timed(("validate",))
+def parse_message(data):
+
+    """
+    Parses and validates the sms once
+    :param data: parameters of the request or an entry of a batch
+    :return: tuple of SmsMessage and error statement, message is None if there is an error
+    """
+    values = {}
+    for name, attribute, normalize, check in RULES:
+        value = get_parameter(data, name)
+        if not value:
+            return None, MISSING_ERROR % name
+        values[attribute] = value
+
+    for name, attribute, normalize, check in RULES:
+        value = values[attribute]
+        if not isinstance(value, basestring):
+            return None, INVALID_ERROR % name
+        if normalize:
+            value = values[attribute] = normalize(value)
+        if not check(value):
+            return None, INVALID_ERROR % name
+
+    username, password = [get_parameter(data, name) for name in ("username", "password")]
+    return SmsMessage(username=username if isinstance(username, basestring) else None,
+                      password=password if isinstance(password, basestring) else None, **values), None
@@ -0,0 +1,245 @@
+import functools
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from config import METRICS_SAMPLE_RATE
+
+# upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Counter(object):
+
+    """
+    Monotonically increasing value per label set
+    """
+
+    type = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+
+        """
+        :param labels: tuple of label values in the order of label_names
+        :param amount: increment
+        :return: No return
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, labels, value) for labels, value in sorted(values.items())]
+
+
+class Histogram(object):
+
+    """
+    Distribution of observed values per label set, only a fraction of observations is recorded
+    if sample_rate is below 1 so that it can be left on in production
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS, sample_rate=1.0):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self.sample_rate = sample_rate
+        # labels => [count per bucket..., count of values beyond the last bucket, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+
+        """
+        :param value: observed value
+        :param labels: tuple of label values in the order of label_names
+        :return: No return
+        """
+        index = len(self.buckets)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = position
+                break
+
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, labels=()):
+
+        """
+        Observes seconds spent in the block, for a sample of the calls
+        :param labels: tuple of label values in the order of label_names
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            yield
+            return
+
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, labels)
+
+    def timed(self, labels=()):
+
+        """
+        Decorator observing seconds spent in the sampled calls of the function
+        :param labels: tuple of label values in the order of label_names
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def samples(self):
+        with self._lock:
+            values = dict((labels, list(counts)) for labels, counts in self._values.items())
+
+        samples = []
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", labels + (("le", str(bound)),), cumulative))
+            samples.append((self.name + "_count", labels, cumulative))
+            samples.append((self.name + "_sum", labels, counts[-1]))
+        return samples
+
+
+class Gauge(object):
+
+    """
+    Values read from a callback at collection time, e.g. counters maintained by the caches
+    """
+
+    def __init__(self, name, documentation, label_names, collect, type="gauge"):
+
+        """
+        :param collect: returns list of (labels, value)
+        :param type: prometheus metric type
+        """
+        self.type = type
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.collect()]
+
+
+class Registry(object):
+
+    """
+    Collection of metrics of a process rendered in prometheus text format
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+
+        """
+        :return: metrics in prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, self._labels(metric.label_names, labels), value))
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(label_names, labels):
+
+        """
+        Formats label values, extra (name, value) pairs may follow the values of label_names
+        """
+        pairs = []
+        for position, label in enumerate(labels):
+            if isinstance(label, tuple):
+                pairs.append(label)
+            else:
+                pairs.append((label_names[position], label))
+
+        if not pairs:
+            return ""
+
+        escape = lambda value: ("%s" % value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    "sms_stage_seconds", "Seconds spent in every stage of request handling", ("stage",),
+    sample_rate=METRICS_SAMPLE_RATE))
+
+request_seconds = registry.register(Histogram(
+    "sms_request_seconds", "Seconds spent handling requests", ("endpoint",), sample_rate=METRICS_SAMPLE_RATE))
+
+requests_total = registry.register(Counter(
+    "sms_requests_total", "Requests handled by endpoint and result", ("endpoint", "result")))
+
+redis_pool_wait_seconds = registry.register(Histogram(
+    "sms_redis_pool_wait_seconds", "Seconds spent waiting for a free redis connection", (),
+    sample_rate=METRICS_SAMPLE_RATE))
+
+idempotent_requests_total = registry.register(Counter(
+    "sms_idempotent_requests_total", "Requests carrying Idempotency-Key by endpoint and outcome",
+    ("endpoint", "outcome")))
+
+redis_fallbacks_total = registry.register(Counter(
+    "sms_redis_fallbacks_total", "Calls answered from in process state while redis was unavailable", ("function",)))
+
+
+def error_category(error):
+
+    """
+    Classifies error statement returned by the api
+    :param error: error statement
+    :return: category name
+    """
+    if not error:
+        return "ok"
+    if "parameter not found" in error:
+        return "number_not_found"
+    if error.startswith("parameter"):
+        return "invalid_input"
+    if "blocked by STOP request" in error:
+        return "stop_blocked"
+    if "limit reached" in error:
+        return "limit_reached"
+    if "temporarily unavailable" in error:
+        return "unavailable"
+    if "queue is full" in error:
+        return "queue_full"
+    if error == "403 Forbidden":
+        return "forbidden"
+    return "failure"
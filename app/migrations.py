@@ -0,0 +1,115 @@
+from sqlalchemy import text, inspect
+
+from app import db
+from credentials import hash_secret
+from config import NUMBER_DIRECTORY_CHANNEL
+
+
+# accounts hashed and committed per transaction by hash_auth_ids, pbkdf2 takes ~0.1s per account
+HASH_CHUNK_SIZE = 50
+
+
+def hash_auth_ids(connection):
+
+    """
+    Hashes the plain text auth ids of the accounts not hashed on login yet. Accounts are hashed and committed in
+    chunks of HASH_CHUNK_SIZE on their own transactions, so rows are locked for seconds, not for the whole run,
+    and an interrupted run resumes where it stopped
+    :param connection: connection of the migration transaction, left idle so that it holds no snapshot meanwhile
+    :return: No return
+    """
+
+    columns = [column["name"] for column in inspect(db.engine).get_columns("account")]
+    if "auth_id" not in columns:
+        return
+
+    last_id = 0
+    while True:
+        with db.engine.begin() as chunk:
+            rows = chunk.execute(text("SELECT id, auth_id FROM account WHERE id > :last_id AND auth_hash IS NULL "
+                                      "AND auth_id IS NOT NULL ORDER BY id LIMIT :limit"),
+                                 last_id=last_id, limit=HASH_CHUNK_SIZE).fetchall()
+            if not rows:
+                return
+
+            # an account hashed on login meanwhile keeps its hash
+            chunk.execute(text("UPDATE account SET auth_hash = :auth_hash, auth_id = NULL "
+                               "WHERE id = :id AND auth_hash IS NULL"),
+                          [dict(id=account_id, auth_hash=hash_secret(auth_id)) for account_id, auth_id in rows])
+            last_id = rows[-1][0]
+
+
+# Ordered list of (name, statements) applied on top of tables created by db.create_all().
+# Names already recorded in schema_migration table are skipped, so upgrade can be run any number of times.
+MIGRATIONS = [
+    ("0001_authentication_indexes", [
+        "CREATE INDEX IF NOT EXISTS ix_account_username_auth_id ON account (username, auth_id)",
+        # fails if same number is registered more than once for an account, remove duplicates before upgrade
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_phone_number_number_account_id ON phone_number (number, account_id)",
+    ]),
+    ("0002_account_rate_limiter", [
+        "ALTER TABLE account ADD COLUMN IF NOT EXISTS rate_limiter VARCHAR(20)",
+    ]),
+    ("0003_account_auth_hash", [
+        # auth ids are hashed on login and by 0006, the plain text column is kept till all of them are
+        "ALTER TABLE account ADD COLUMN IF NOT EXISTS auth_hash VARCHAR(128)",
+        "DROP INDEX IF EXISTS ix_account_username_auth_id",
+        "CREATE INDEX IF NOT EXISTS ix_account_username ON account (username)",
+    ]),
+    ("0004_quota_tiers", [
+        # quota_tier table itself is created by db.create_all()
+        "ALTER TABLE account ADD COLUMN IF NOT EXISTS quota_tier_id INTEGER REFERENCES quota_tier (id)",
+        "ALTER TABLE phone_number ADD COLUMN IF NOT EXISTS quota_tier_id INTEGER REFERENCES quota_tier (id)",
+    ]),
+    ("0005_phone_number_notify", [
+        # every committed change of a number is published to the number directories of the workers
+        """
+        CREATE OR REPLACE FUNCTION notify_phone_number_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM pg_notify('%(channel)s', json_build_array('-', OLD.account_id, OLD.number)::text);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM pg_notify('%(channel)s', json_build_array('+', NEW.account_id, NEW.number)::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """ % dict(channel=NUMBER_DIRECTORY_CHANNEL),
+        "DROP TRIGGER IF EXISTS phone_number_notify ON phone_number",
+        "CREATE TRIGGER phone_number_notify AFTER INSERT OR UPDATE OR DELETE ON phone_number "
+        "FOR EACH ROW EXECUTE PROCEDURE notify_phone_number_change()",
+    ]),
+    ("0006_hash_auth_ids", [
+        hash_auth_ids,
+    ]),
+]
+
+
+def upgrade():
+
+    """
+    Applies pending migrations to the configured database, each migration runs in its own transaction
+    :return: list of applied migration names
+    """
+
+    applied = []
+    with db.engine.begin() as connection:
+        connection.execute(text("CREATE TABLE IF NOT EXISTS schema_migration (name VARCHAR(100) PRIMARY KEY)"))
+        done = set(row[0] for row in connection.execute(text("SELECT name FROM schema_migration")))
+
+    for name, statements in MIGRATIONS:
+        if name in done:
+            continue
+
+        with db.engine.begin() as connection:
+            for statement in statements:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.execute(text(statement))
+            connection.execute(text("INSERT INTO schema_migration (name) VALUES (:name)"), name=name)
+
+        applied.append(name)
+
+    return applied
@@ -1,13 +1,124 @@
 from app import db
+from credentials import hash_secret, verify_secret, verify_plain_secret
+
+
+class QuotaTier(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(30), unique=True)
+    # outbound smses allowed per number in window_seconds
+    sms_limit = db.Column(db.Integer)
+    window_seconds = db.Column(db.Integer)
 
 
 class Account(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    auth_id = db.Column(db.String(40))
+    # pbkdf2 hash of the auth id, the auth id itself is never stored
+    auth_hash = db.Column(db.String(128))
+    # plain text auth id of accounts created before auth_hash, cleared once it is hashed on the next login or by
+    # migration 0006, never written for new accounts. The column is dropped once no account has it
+    plain_auth_id = db.Column("auth_id", db.String(40))
     username = db.Column(db.String(30))
+    # rate limiter strategy, DEFAULT_RATE_LIMITER is used if not set
+    rate_limiter = db.Column(db.String(20))
+    # quota of all the numbers of the account, DEFAULT_SMS_LIMIT/DEFAULT_SMS_WINDOW is used if not set
+    quota_tier_id = db.Column(db.Integer, db.ForeignKey('quota_tier.id'))
+
+    __table_args__ = (
+        db.Index('ix_account_username', 'username'),
+    )
+
+    @property
+    def auth_id(self):
+        raise AttributeError("only hash of the auth id is stored, use check_auth_id")
+
+    @auth_id.setter
+    def auth_id(self, secret):
+        self.auth_hash = hash_secret(secret)
+
+    def check_auth_id(self, secret):
+        return check_account_secret(self.id, secret, self.auth_hash, self.plain_auth_id)
 
 
 class phone_number(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     number = db.Column(db.String(40))
     account_id = db.Column(db.Integer, db.ForeignKey('account.id'))
+    # overrides quota tier of the account if set
+    quota_tier_id = db.Column(db.Integer, db.ForeignKey('quota_tier.id'))
+
+    __table_args__ = (
+        db.Index('ux_phone_number_number_account_id', 'number', 'account_id', unique=True),
+    )
+
+
+class UsageRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'))
+    number = db.Column(db.String(40))
+    # "hour" or "day", period_start is the utc start of the period
+    period = db.Column(db.String(10))
+    period_start = db.Column(db.DateTime)
+    inbound = db.Column(db.Integer, default=0)
+    outbound = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.Index('ux_usage_rollup_account_id_number_period', 'account_id', 'number', 'period', 'period_start',
+                 unique=True),
+    )
+
+
+class StopRequest(db.Model):
+    # stop key e.g. INBOUND_<from number> and the number it blocks, persisted copy of the redis key
+    key = db.Column(db.String(60), primary_key=True)
+    value = db.Column(db.String(40))
+    # utc time at which the stop request expires
+    expires_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_stop_request_expires_at', 'expires_at'),
+    )
+
+
+def check_account_secret(account_id, secret, auth_hash, plain_auth_id):
+
+    """
+    Checks secret of the account, an account whose auth id is not hashed yet is checked against the plain one
+    and hashed once it matches
+    :param account_id: account id
+    :param secret: auth id posted by the client
+    :param auth_hash: stored hash or None
+    :param plain_auth_id: stored plain text auth id or None
+    :return: True if secret matches
+    """
+    if auth_hash or not plain_auth_id:
+        return verify_secret(secret, auth_hash)
+
+    if not verify_plain_secret(secret, plain_auth_id):
+        return False
+
+    # outside of the session of the request, an account hashed meanwhile keeps its hash
+    account = Account.__table__
+    db.engine.execute(account.update().where(db.and_(account.c.id == account_id, account.c.auth_hash == None))
+                      .values(auth_hash=hash_secret(secret), auth_id=None))
+    return True
+
+
+def find_account_number(username, auth_id, number):
+
+    """
+    Authenticates the account and checks if number belongs to it in a single query
+    :param username: account username
+    :param auth_id: account auth id
+    :param number: phone number
+    :return: tuple of account id (None if credentials are invalid) and True if number belongs to the account
+    """
+
+    rows = db.session.query(Account.id, Account.auth_hash, Account.plain_auth_id, phone_number.id).outerjoin(
+        phone_number, db.and_(phone_number.account_id == Account.id, phone_number.number == number)
+    ).filter(Account.username == username).all()
+
+    for account_id, auth_hash, plain_auth_id, number_id in rows:
+        if check_account_secret(account_id, auth_id, auth_hash, plain_auth_id):
+            return account_id, number_id is not None
+
+    return None, False
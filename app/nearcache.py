@@ -0,0 +1,362 @@
+import json
+import os
+import random
+import threading
+import time
+
+from cache import TTLCache, MISSING
+
+
+class StopNearCache(object):
+
+    """
+    Per process cache of stop requests in front of redis, "" is cached for numbers without stop request.
+    Every stop request is published on a redis channel and applied to the caches of all the processes.
+    Cached entries are served only while the process is subscribed to the channel,
+    so a missed invalidation can never leave a stale entry behind.
+    Optionally keys starting with filter_prefix are first checked against a bloom filter of all the registered
+    stop requests, which is built from redis after every subscription, so definite negatives skip redis.
+    The same scan seeds the snapshot of stop requests answered while redis is unavailable. As every process scans
+    redis, rebuilds after the first one are delayed by a random jitter and rate limited
+    """
+
+    def __init__(self, maxsize, ttl, channel, get_connection, get_all_connections, enabled=True, stop_filter=None,
+                 filter_prefix="", snapshot=None, reload_jitter=0, reload_interval=0):
+
+        """
+        :param maxsize: maximum number of cached keys
+        :param ttl: seconds after which an entry expires, must not exceed stop request expiry
+        :param channel: redis channel on which stop requests are published
+        :param get_connection: returns redis connection used for subscribing
+        :param get_all_connections: returns connections of all the redis nodes holding stop requests
+        :param enabled: all lookups go to redis if False
+        :param stop_filter: ExpiringBloomFilter or None
+        :param filter_prefix: prefix of the stop keys tracked by the filter
+        :param snapshot: TTLCache keeping every stop request seen, served while redis is unavailable
+        :param reload_jitter: maximum seconds a rebuild after the first one is delayed by
+        :param reload_interval: minimum seconds between rebuilds
+        """
+        self.enabled = enabled
+        self.stop_filter = stop_filter
+        self.filter_prefix = filter_prefix
+        self.snapshot = snapshot
+        self.filter_ready = False
+        self.filter_negatives = 0
+        self.filter_build_time = 0.0
+        self.filter_builds = 0
+        self.reload_jitter = reload_jitter
+        self.reload_interval = reload_interval
+        # time of the pending rebuild, None if there is none
+        self.rebuild_at = None
+        self._built_at = 0
+        self.cache = TTLCache(maxsize, ttl)
+        self.channel = channel
+        self.get_connection = get_connection
+        self.get_all_connections = get_all_connections
+        self.invalidations = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        # bumped on every invalidation, lookups started before it are not cached
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._subscribed = threading.Event()
+        self._pid = None
+
+    @property
+    def subscribed(self):
+
+        """
+        :return: True if cached entries are being served
+        """
+        return self._subscribed.is_set()
+
+    def start(self):
+
+        """
+        Starts the subscriber thread, once per process
+        :return: No return
+        """
+        pid = os.getpid()
+        if self._pid == pid or not self.enabled:
+            return
+
+        with self._lock:
+            if self._pid != pid:
+                self._subscribed = threading.Event()
+                self.cache.clear()
+                thread = threading.Thread(target=self._listen, name="stop-near-cache")
+                thread.daemon = True
+                thread.start()
+                self._pid = pid
+
+    def get(self, key):
+
+        """
+        Returns cached stop request value of key
+        :param key: stop key
+        :return: value, "" if no stop request is registered or MISSING if it has to be looked up in redis
+        """
+        self.start()
+        if not self.enabled or not self._subscribed.is_set():
+            return MISSING
+
+        if self.filter_ready and key.startswith(self.filter_prefix) and key not in self.stop_filter:
+            self.filter_negatives += 1
+            return ""
+
+        return self.cache.get(key)
+
+    def set(self, key, value, generation, ttl=None):
+
+        """
+        Caches value looked up in redis
+        :param key: stop key
+        :param value: value found in redis, None if not found
+        :param generation: value of self.generation read before the lookup
+        :param ttl: remaining expiry of the stop request in seconds
+        :return: No return
+        """
+        with self._lock:
+            if generation == self.generation and self._subscribed.is_set():
+                self.cache.set(key, value or "", self._ttl(value, ttl))
+
+        self._remember(key, value, ttl)
+
+    def publish(self, pipe, key, value, expiry):
+
+        """
+        Publishes a new stop request, or queues it on the pipeline which registers it
+        :param pipe: redis pipeline or connection of the first node
+        :param key: stop key
+        :param value: stop value
+        :param expiry: expiry of the stop request in seconds
+        :return: No return
+        """
+        pipe.publish(self.channel, json.dumps({"key": key, "value": value, "ex": expiry, "ts": time.time()}))
+
+    def publish_reload(self, pipe):
+
+        """
+        Makes every process drop its cache and rebuild its filter, e.g. after stop requests were restored in bulk
+        :param pipe: redis pipeline or connection of the first node
+        :return: No return
+        """
+        pipe.publish(self.channel, json.dumps({"reload": True, "ts": time.time()}))
+
+    def invalidate(self, key, value, expiry):
+
+        """
+        Applies a new stop request to the cache
+        :param key: stop key
+        :param value: stop value
+        :param expiry: remaining expiry of the stop request in seconds
+        :return: No return
+        """
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            self.cache.set(key, value, self._ttl(value, expiry))
+
+        if self.stop_filter is not None:
+            self.stop_filter.add(key, expiry)
+        self._remember(key, value, expiry)
+
+    def _remember(self, key, value, expiry):
+        if self.snapshot is not None and value:
+            self.snapshot.set(key, value, expiry if expiry > 0 else None)
+
+    def clear(self):
+
+        """
+        Drops all the entries, e.g. after stop requests have been removed from redis
+        :return: No return
+        """
+        with self._lock:
+            self.generation += 1
+            self.cache.clear()
+
+    def reset(self):
+
+        """
+        Drops all the entries and stops serving from the cache till subscription is confirmed again
+        :return: No return
+        """
+        with self._lock:
+            self._subscribed.clear()
+            self.filter_ready = False
+            self.generation += 1
+            self.cache.clear()
+
+    def build_filter(self, pubsub=None):
+
+        """
+        Rebuilds the bloom filter from stop keys found in redis, their values seed the snapshot so that
+        stop requests registered before this process started are still blocked while redis is unavailable.
+        The filter is built aside and swapped in, then stop requests published during the scan are applied
+        before it answers lookups.
+        Must be called after subscribing so that stop requests registered meanwhile are not missed
+        :param pubsub: subscription of the channel whose queued messages are applied, if any
+        :return: No return
+        """
+        started = time.time()
+        self.filter_ready = False
+        self.rebuild_at = None
+        stop_filter = self.stop_filter.empty() if self.stop_filter is not None else None
+        for redis_conn in self.get_all_connections():
+            keys = []
+            for key in redis_conn.scan_iter(match=self.filter_prefix + "*", count=1000):
+                keys.append(key)
+                if len(keys) == 1000:
+                    self._add_to_filter(redis_conn, keys, stop_filter)
+                    keys = []
+            self._add_to_filter(redis_conn, keys, stop_filter)
+
+        if stop_filter is not None:
+            self.stop_filter.replace(stop_filter)
+
+        rebuild = False
+        while pubsub is not None:
+            message = pubsub.get_message(timeout=0)
+            if message is None:
+                break
+            rebuild = self._apply(message) or rebuild
+
+        self._built_at = time.time()
+        self.filter_builds += 1
+        self.filter_build_time = self._built_at - started
+        # a reload published during the scan is rebuilt for as well
+        if rebuild:
+            self.schedule_rebuild()
+        else:
+            self.filter_ready = self.stop_filter is not None
+
+    def schedule_rebuild(self):
+
+        """
+        Schedules a rebuild of the filter and the snapshot, the first one is due right away and later ones after
+        a random jitter, at least reload_interval seconds after the last one. The filter is not consulted till then,
+        it may miss stop requests written to redis in bulk
+        :return: No return
+        """
+        self.filter_ready = False
+        if self.rebuild_at is not None:
+            return
+
+        now = time.time()
+        if self._built_at:
+            self.rebuild_at = max(now + random.uniform(0, self.reload_jitter), self._built_at + self.reload_interval)
+        else:
+            self.rebuild_at = now
+
+    def _add_to_filter(self, redis_conn, keys, stop_filter):
+
+        """
+        Adds keys to the bloom filter and the snapshot along with their remaining expiry
+        :param redis_conn: redis connection
+        :param keys: list of stop keys
+        :param stop_filter: ExpiringBloomFilter being built or None
+        :return: No return
+        """
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.ttl(key)
+            pipe.get(key)
+
+        results = pipe.execute()
+        for key, ttl, value in zip(keys, results[::2], results[1::2]):
+            # key has expired meanwhile
+            if ttl == -2 or value is None:
+                continue
+            if stop_filter is not None:
+                stop_filter.add(key, ttl)
+            self._remember(key, value, ttl)
+
+    def _ttl(self, value, expiry):
+
+        """
+        Returns ttl of a cache entry, stop requests are never cached beyond their expiry
+        :param value: stop value
+        :param expiry: remaining expiry of the stop request in seconds, negative if it does not expire
+        :return: ttl in seconds
+        """
+        if value and expiry is not None and expiry >= 0:
+            return min(expiry, self.cache.ttl)
+
+        return self.cache.ttl
+
+    def stats(self):
+
+        """
+        Returns cache metrics
+        :return: dict of metric name => value
+        """
+        lookups = self.cache.hits + self.cache.misses + self.filter_negatives
+        stats = {
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "hit_rate": float(self.cache.hits + self.filter_negatives) / lookups if lookups else 0.0,
+            "size": len(self.cache),
+            "invalidations": self.invalidations,
+            "last_invalidation_lag": self.last_lag,
+            "max_invalidation_lag": self.max_lag,
+        }
+
+        if self.stop_filter is not None:
+            for name, value in self.stop_filter.stats().items():
+                stats["filter_" + name] = value
+            stats["filter_negatives"] = self.filter_negatives
+            stats["filter_build_time"] = self.filter_build_time
+            stats["filter_builds"] = self.filter_builds
+
+        return stats
+
+    def _apply(self, message):
+
+        """
+        Applies a message of the channel
+        :param message: pub/sub message
+        :return: True if the filter and the snapshot have to be rebuilt from redis
+        """
+        if message["type"] == "subscribe":
+            self._subscribed.set()
+            return self.stop_filter is not None or self.snapshot is not None
+
+        if message["type"] != "message":
+            return False
+
+        data = json.loads(message["data"])
+        if data.get("reload"):
+            self.clear()
+            return self.stop_filter is not None or self.snapshot is not None
+
+        lag = max(time.time() - data["ts"], 0.0)
+        self.invalidate(data["key"], data["value"], data["ex"] - lag)
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, self.last_lag)
+        return False
+
+    def _listen(self):
+
+        """
+        Subscriber thread, applies published stop requests and resubscribes on failure
+        :return: No return
+        """
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.get_connection().pubsub()
+                pubsub.subscribe(self.channel)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None and self._apply(message):
+                        self.schedule_rebuild()
+                    if self.rebuild_at is not None and time.time() >= self.rebuild_at:
+                        self.build_filter(pubsub)
+            except Exception as e:
+                print e
+            finally:
+                self.reset()
+                if pubsub is not None:
+                    pubsub.close()
+
+            time.sleep(1)
@@ -0,0 +1,323 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from app import db
+from models import StopRequest
+
+# a newer stop request of the key is never replaced by an older one flushed late by another process
+UPSERT = text("""
+INSERT INTO stop_request (key, value, expires_at) VALUES (:key, :value, :expires_at)
+ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+WHERE stop_request.expires_at <= excluded.expires_at
+""")
+
+PURGE = text("DELETE FROM stop_request WHERE expires_at <= :now")
+
+# claims the restore of a node unless it is claimed already or its marker was written by the same redis server.
+# KEYS[1] => marker, ARGV[1] => marker prefix of this server, ARGV[2] => claim, ARGV[3] => lock timeout
+CLAIM = """
+local marker = redis.call("GET", KEYS[1])
+if marker and (string.sub(marker, 1, 10) == "restoring:" or string.sub(marker, 1, #ARGV[1]) == ARGV[1]) then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+return 1
+"""
+
+# extends the restore claim of a node only while it is still held by this process
+REFRESH_CLAIM = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# replaces the restore claim of a node by its marker only while it is still held by this process
+RELEASE_CLAIM = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    redis.call("SET", KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+class StopRequestStore(object):
+
+    """
+    Persists stop requests to postgres behind the request path and restores them into redis after it lost them.
+    Stop requests are buffered in memory and upserted in a single batch by a background thread, stop requests
+    of a failed flush are kept for the next one. The same thread checks the restore marker of every redis node,
+    a node without it has been flushed and a node whose marker carries the run id of another redis server is a
+    replica promoted after a failover, which may have missed the last writes. Either is restored from postgres by
+    the first process noticing it.
+    The process restoring a node extends its claim after every batch, so a restore left unfinished by a process
+    which died is taken over after lock_timeout seconds
+    """
+
+    def __init__(self, get_connection, get_all_connections, marker, flush_interval, flush_size, purge_interval,
+                 check_interval, lock_timeout, batch_size, enabled=True):
+
+        """
+        :param get_connection: returns redis connection of the node owning a key
+        :param get_all_connections: returns connections of all the redis nodes holding stop requests
+        :param marker: key present on every redis node which holds the restored stop requests, its value carries
+                       the run id of the redis server it was written to
+        :param flush_interval: seconds between flushes
+        :param flush_size: number of pending stop requests which triggers an early flush
+        :param purge_interval: seconds between deletes of expired stop requests
+        :param check_interval: seconds between checks of the restore markers
+        :param lock_timeout: seconds without progress after which a restore of a node is taken over by
+                             another process
+        :param batch_size: stop requests read and written per round trip while restoring
+        :param enabled: record and restore are no-ops if False
+        """
+        self.get_connection = get_connection
+        self.get_all_connections = get_all_connections
+        self.marker = marker
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.purge_interval = purge_interval
+        self.check_interval = check_interval
+        self.lock_timeout = lock_timeout
+        self.batch_size = batch_size
+        self.enabled = enabled
+        self.flushed = 0
+        self.failures = 0
+        self.last_restore = None
+        # called after a restore, e.g. to let other processes rebuild their stop filters
+        self.on_restore = []
+        # key => (value, expires at)
+        self._pending = {}
+        self._purged_at = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+
+    def start(self):
+
+        """
+        Starts the flusher thread, once per process
+        :return: No return
+        """
+        pid = os.getpid()
+        if not self.enabled or self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid != pid:
+                # stop requests inherited from the parent are flushed by the parent
+                self._pending = {}
+                thread = threading.Thread(target=self._run, name="stop-request-store")
+                thread.daemon = True
+                thread.start()
+                self._pid = pid
+
+    def record(self, key, value, expiry):
+
+        """
+        :param key: stop key
+        :param value: stop value
+        :param expiry: expiry in seconds
+        :return: No return
+        """
+        if not self.enabled:
+            return
+
+        self.start()
+        expires_at = datetime.utcnow() + timedelta(seconds=expiry)
+        with self._lock:
+            self._pending[key] = (value, expires_at)
+            pending = len(self._pending)
+
+        if pending >= self.flush_size:
+            self._wakeup.set()
+
+    def flush(self):
+
+        """
+        Writes pending stop requests to postgres, expired ones are purged every purge_interval seconds
+        :return: number of stop requests written
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+
+            rows = [dict(key=key, value=value, expires_at=expires_at)
+                    for key, (value, expires_at) in pending.items()]
+            purge = time.time() - self._purged_at >= self.purge_interval
+            if not rows and not purge:
+                return 0
+
+            try:
+                with db.engine.begin() as connection:
+                    if rows:
+                        connection.execute(UPSERT, rows)
+                    if purge:
+                        connection.execute(PURGE, now=datetime.utcnow())
+            except Exception:
+                self.failures += 1
+                self._restore_pending(pending)
+                raise
+
+            if purge:
+                self._purged_at = time.time()
+            self.flushed += len(rows)
+            return len(rows)
+
+    def clear(self):
+
+        """
+        Drops pending stop requests
+        :return: No return
+        """
+        with self._lock:
+            self._pending = {}
+
+    def _restore_pending(self, pending):
+        with self._lock:
+            for key, item in pending.items():
+                current = self._pending.get(key)
+                if current is None or current[1] < item[1]:
+                    self._pending[key] = item
+
+    def unexpired(self):
+
+        """
+        Streams the stop requests which have not expired yet
+        :return: generator of lists of (key, value, expires at) with upto batch_size items
+        """
+        table = StopRequest.__table__
+        with db.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(
+                db.select([table.c.key, table.c.value, table.c.expires_at])
+                .where(table.c.expires_at > datetime.utcnow()))
+            while True:
+                rows = result.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    def lost(self, redis_conn):
+
+        """
+        Tells whether the node lost stop requests since its last restore
+        :param redis_conn: connection of the node
+        :return: tuple of True if the node has to be restored and its marker prefix
+        """
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.get(self.marker)
+        pipe.info("server")
+        marker, info = pipe.execute()
+        prefix = "restored:%s:" % info["run_id"]
+        # a claimed node is being restored by another process
+        return not marker or not (marker.startswith("restoring:") or marker.startswith(prefix)), prefix
+
+    def restore(self, force=False):
+
+        """
+        Writes unexpired stop requests back to the redis nodes which lost them, in pipelined batches.
+        Keys present in redis are left untouched, they are at least as recent as the persisted ones
+        :param force: restore every node even if its marker is present
+        :return: dict with number of nodes restored, stop requests written and seconds taken,
+                 None if no node had to be restored
+        """
+        if not self.enabled:
+            return None
+
+        started = time.time()
+        claim = "restoring:%d:%f" % (os.getpid(), started)
+        nodes = {}
+        prefixes = {}
+        for redis_conn in self.get_all_connections():
+            lost, prefix = self.lost(redis_conn)
+            if force:
+                redis_conn.set(self.marker, claim, ex=self.lock_timeout)
+            elif not lost or not redis_conn.eval(CLAIM, 1, self.marker, prefix, claim, self.lock_timeout):
+                continue
+            nodes[id(redis_conn)] = redis_conn
+            prefixes[id(redis_conn)] = prefix
+        if not nodes:
+            return None
+
+        restored = 0
+        for rows in self.unexpired():
+            now = datetime.utcnow()
+            pipes = {}
+            for node_id, redis_conn in nodes.items():
+                pipe = pipes[node_id] = redis_conn.pipeline(transaction=False)
+                pipe.eval(REFRESH_CLAIM, 1, self.marker, claim, self.lock_timeout)
+
+            for key, value, expires_at in rows:
+                redis_conn = self.get_connection(key)
+                ttl = int((expires_at - now).total_seconds())
+                if id(redis_conn) not in nodes or ttl < 1:
+                    continue
+                pipes[id(redis_conn)].set(key, value, ex=ttl, nx=True)
+
+            for pipe in pipes.values():
+                restored += len([result for result in pipe.execute()[1:] if result])
+
+        # a process which lost its claim leaves the marker to the one which took over
+        for node_id, redis_conn in nodes.items():
+            marker = "%s%d" % (prefixes[node_id], time.time())
+            if not redis_conn.eval(RELEASE_CLAIM, 1, self.marker, claim, marker):
+                print "restore claim of a redis node was taken over by another process"
+
+        self.last_restore = dict(nodes=len(nodes), restored=restored, seconds=time.time() - started)
+        print "restored %(restored)d stop requests to %(nodes)d redis nodes in %(seconds).3fs" % self.last_restore
+        for callback in self.on_restore:
+            callback()
+
+        return self.last_restore
+
+    def stats(self):
+        stats = dict(pending=len(self._pending), flushed=self.flushed, failures=self.failures)
+        if self.last_restore is not None:
+            stats.update(("last_restore_" + name, value) for name, value in self.last_restore.items())
+        return stats
+
+    def _run(self):
+        checked_at = 0
+        flushed_at = time.time()
+        while True:
+            self._wakeup.wait(max(min(flushed_at + self.flush_interval, checked_at + self.check_interval)
+                                  - time.time(), 0))
+            # a lost node is restored first, a slow or failing flush must not hold it up
+            if time.time() - checked_at >= self.check_interval:
+                checked_at = time.time()
+                try:
+                    self.restore()
+                except Exception as e:
+                    print e
+
+            if self._wakeup.is_set() or time.time() - flushed_at >= self.flush_interval:
+                self._wakeup.clear()
+                flushed_at = time.time()
+                try:
+                    self.flush()
+                except Exception as e:
+                    print e
+
+
+def flush_on_exit(store):
+
+    """
+    Registers a final flush of the pending stop requests of the process owning the store
+    :param store: StopRequestStore
+    :return: No return
+    """
+    def flush():
+        if store._pid == os.getpid():
+            try:
+                store.flush()
+            except Exception as e:
+                print e
+
+    atexit.register(flush)
@@ -0,0 +1,220 @@
+import csv
+import json
+from StringIO import StringIO
+
+from app import db
+from models import Account, phone_number
+from message import normalize_number, valid_number
+from utils import invalidate_number
+from config import PROVISION_CHUNK_SIZE, PROVISION_MAX_REPORTED_ERRORS
+
+FORMATS = ("csv", "jsonl")
+
+
+def read_records(lines, format="csv"):
+
+    """
+    Parses provisioning input lazily, every record has username, number and optionally auth_id
+    which is needed only for accounts that do not exist yet
+    :param lines: iterable of lines e.g. an open file or request stream
+    :param format: "csv" with a header row or "jsonl" with one json object per line
+    :return: generator of (line number, record), record is None for a line which is not valid json
+    """
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+    elif format == "jsonl":
+        for line_num, line in enumerate(lines, 1):
+            if line.strip():
+                # a malformed line is rejected on its own rather than aborting the load
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    yield line_num, None
+                    continue
+                yield line_num, record if isinstance(record, dict) else {}
+    else:
+        raise ValueError("unknown provisioning format %s, expected one of %s" % (format, ", ".join(FORMATS)))
+
+
+class ProvisioningReport(object):
+
+    """
+    Counts of a provisioning run, along with the first PROVISION_MAX_REPORTED_ERRORS rejected rows
+    """
+
+    def __init__(self):
+        self.accounts_created = 0
+        self.numbers_created = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line_num, number, error):
+        self.rejected += 1
+        if len(self.errors) < PROVISION_MAX_REPORTED_ERRORS:
+            self.errors.append(dict(line=line_num, number=number, error=error))
+
+    def as_dict(self):
+        return dict(accounts_created=self.accounts_created, numbers_created=self.numbers_created,
+                    duplicates=self.duplicates, rejected=self.rejected, errors=self.errors)
+
+
+class Provisioner(object):
+
+    """
+    Loads accounts and numbers in bulk. Numbers are de-duplicated within the load and against the database,
+    a number already owned by another account is rejected as a conflict
+    """
+
+    def __init__(self, chunk_size=PROVISION_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.report = ProvisioningReport()
+        # username => account id, number => account id of the rows seen so far
+        self.accounts = {}
+        self.owners = {}
+        self.created = []
+
+    def load(self, records):
+
+        """
+        :param records: iterable of (line number, record)
+        :return: ProvisioningReport
+        """
+        chunk = []
+        for line_num, record in records:
+            chunk.append((line_num, record))
+            if len(chunk) >= self.chunk_size:
+                self.load_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.load_chunk(chunk)
+
+        self.invalidate_caches()
+        return self.report
+
+    def load_chunk(self, chunk):
+
+        """
+        Validates and inserts one chunk in a single transaction
+        :param chunk: list of (line number, record)
+        :return: No return
+        """
+        valid = []
+        for line_num, record in chunk:
+            if record is None:
+                self.report.reject(line_num, None, "line is not valid json")
+                continue
+            number = normalize_number(u"%s" % (record.get("number") or ""))
+            username = record.get("username")
+            if not username:
+                self.report.reject(line_num, number, "parameter 'username' is missing")
+            elif not valid_number(number):
+                self.report.reject(line_num, number, "parameter 'number' is invalid")
+            else:
+                valid.append((line_num, username, record.get("auth_id"), number))
+
+        try:
+            self.resolve_accounts(valid)
+            self.resolve_owners([number for line_num, username, auth_id, number in valid])
+
+            rows = []
+            for line_num, username, auth_id, number in valid:
+                account_id = self.accounts.get(username)
+                owner = self.owners.get(number)
+                if account_id is None:
+                    self.report.reject(line_num, number, "account %s does not exist and auth_id is missing" % username)
+                elif owner == account_id:
+                    self.report.duplicates += 1
+                elif owner is not None:
+                    self.report.reject(line_num, number, "number is owned by another account")
+                else:
+                    self.owners[number] = account_id
+                    rows.append((number, account_id))
+
+            self.insert_numbers(rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        self.created.extend(rows)
+        self.report.numbers_created += len(rows)
+
+    def resolve_accounts(self, valid):
+
+        """
+        Looks up accounts of the chunk in one query and creates missing ones which carry an auth_id
+        """
+        usernames = set(username for line_num, username, auth_id, number in valid) - set(self.accounts)
+        if not usernames:
+            return
+
+        for account_id, username in db.session.query(Account.id, Account.username).filter(
+                Account.username.in_(usernames)):
+            self.accounts.setdefault(username, account_id)
+
+        new_accounts = {}
+        for line_num, username, auth_id, number in valid:
+            if username not in self.accounts and username not in new_accounts and auth_id:
+                new_accounts[username] = Account(username=username, auth_id=auth_id)
+        if new_accounts:
+            db.session.add_all(new_accounts.values())
+            db.session.flush()
+            for username, account in new_accounts.items():
+                self.accounts[username] = account.id
+            self.report.accounts_created += len(new_accounts)
+
+    def resolve_owners(self, numbers):
+
+        """
+        Looks up owners of the numbers of the chunk which were not seen before in one query
+        """
+        numbers = set(numbers) - set(self.owners)
+        if not numbers:
+            return
+
+        for number, account_id in db.session.query(phone_number.number, phone_number.account_id).filter(
+                phone_number.number.in_(numbers)):
+            self.owners.setdefault(number, account_id)
+
+    def insert_numbers(self, rows):
+
+        """
+        Inserts (number, account id) rows, with COPY on postgres and executemany elsewhere
+        """
+        if not rows:
+            return
+
+        connection = db.session.connection()
+        if connection.dialect.name == "postgresql":
+            buffer = StringIO()
+            csv.writer(buffer).writerows(rows)
+            buffer.seek(0)
+            cursor = connection.connection.cursor()
+            cursor.copy_expert("COPY phone_number (number, account_id) FROM STDIN WITH CSV", buffer)
+        else:
+            connection.execute(phone_number.__table__.insert(),
+                               [dict(number=number, account_id=account_id) for number, account_id in rows])
+
+    def invalidate_caches(self):
+
+        """
+        Rows inserted in bulk bypass the orm events, drop cached failed lookups of them in one go.
+        New accounts are added through the orm and invalidate the account cache themselves
+        """
+        for number, account_id in self.created:
+            invalidate_number(account_id, number)
+
+
+def provision(lines, format="csv", chunk_size=PROVISION_CHUNK_SIZE):
+
+    """
+    Loads accounts and numbers from csv or jsonl input
+    :param lines: iterable of lines
+    :param format: "csv" or "jsonl"
+    :param chunk_size: rows per transaction
+    :return: ProvisioningReport
+    """
+    return Provisioner(chunk_size).load(read_records(lines, format))
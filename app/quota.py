@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+
+from app import db
+from models import QuotaTier, Account, phone_number
+from config import DEFAULT_SMS_LIMIT, DEFAULT_SMS_WINDOW, QUOTA_REFRESH_INTERVAL
+
+
+class QuotaPolicies(object):
+
+    """
+    In memory snapshot of the quota tiers of all the accounts and numbers which have one, so that resolving
+    the quota of a number needs no query. Only the first lookup of a process loads the snapshot inline, later
+    it is reloaded by a background thread every refresh_interval seconds and right away after the tiers are
+    changed by this process, lookups keep being served from the previous snapshot meanwhile
+    """
+
+    def __init__(self, refresh_interval, default=(DEFAULT_SMS_LIMIT, DEFAULT_SMS_WINDOW)):
+
+        """
+        :param refresh_interval: seconds between reloads
+        :param default: (limit, window) of numbers without tier
+        """
+        self.refresh_interval = refresh_interval
+        self.default = default
+        self.loads = 0
+        # account id => (limit, window), (account id, number) => (limit, window)
+        self._accounts = {}
+        self._numbers = {}
+        self._stale = True
+        self._loaded = False
+        # inline load is not retried before this time once it failed, e.g. while the database is down
+        self._retry_at = 0
+        # bumped by invalidate, a load which raced with it leaves the snapshot stale
+        self._version = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+
+    def start(self):
+
+        """
+        Starts the refresher thread, once per process
+        :return: No return
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid != pid:
+                thread = threading.Thread(target=self._run, name="quota-policies")
+                thread.daemon = True
+                thread.start()
+                self._pid = pid
+
+    def get(self, account_id, number):
+
+        """
+        Returns quota of the number, tier of the number overrides tier of the account
+        :param account_id: account id
+        :param number: phone number
+        :return: tuple of limit and window in seconds
+        """
+        if not self._loaded:
+            self._load_once()
+        elif self._stale:
+            # serve the previous snapshot till the refresher has reloaded it
+            self.start()
+            self._wakeup.set()
+
+        policy = self._numbers.get((account_id, "%s" % number))
+        if policy is None:
+            policy = self._accounts.get(account_id, self.default)
+        return policy
+
+    def _load_once(self):
+        with self._load_lock:
+            if self._loaded or time.time() < self._retry_at:
+                return
+            try:
+                self.load()
+            except Exception as e:
+                # numbers get the default quota till the refresher succeeds
+                print e
+                self._retry_at = time.time() + self.refresh_interval
+
+    def load(self):
+
+        """
+        Replaces the snapshot with the tiers in the database, two queries in total.
+        Starts the refresher thread which keeps it current from then on
+        :return: No return
+        """
+        self.start()
+        version = self._version
+        tiers = QuotaTier.__table__
+        accounts = Account.__table__
+        numbers = phone_number.__table__
+        with db.engine.connect() as connection:
+            account_rows = connection.execute(
+                db.select([accounts.c.id, tiers.c.sms_limit, tiers.c.window_seconds])
+                .select_from(accounts.join(tiers, accounts.c.quota_tier_id == tiers.c.id)))
+            account_policies = dict((account_id, (limit, window)) for account_id, limit, window in account_rows)
+
+            number_rows = connection.execute(
+                db.select([numbers.c.account_id, numbers.c.number, tiers.c.sms_limit, tiers.c.window_seconds])
+                .select_from(numbers.join(tiers, numbers.c.quota_tier_id == tiers.c.id)))
+            number_policies = dict(((account_id, "%s" % number), (limit, window))
+                                   for account_id, number, limit, window in number_rows)
+
+        self._accounts, self._numbers = account_policies, number_policies
+        self._stale = self._version != version
+        self._loaded = True
+        self.loads += 1
+
+    def invalidate(self):
+
+        """
+        Reloads the snapshot on next lookup
+        :return: No return
+        """
+        self._version += 1
+        self._stale = True
+
+    def clear(self):
+
+        """
+        Drops the snapshot, next lookup loads it again inline
+        :return: No return
+        """
+        self._version += 1
+        self._accounts, self._numbers = {}, {}
+        self._stale = True
+        self._loaded = False
+        self._retry_at = 0
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.refresh_interval)
+            self._wakeup.clear()
+            try:
+                self.load()
+            except Exception as e:
+                print e
+
+
+quota_policies = QuotaPolicies(QUOTA_REFRESH_INTERVAL)
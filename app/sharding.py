@@ -0,0 +1,62 @@
+import bisect
+import hashlib
+
+
+def shard_key(key):
+
+    """
+    Returns part of the key used for choosing the node. If key contains a {hash tag} only the tag is used,
+    so keys sharing a tag are stored on the same node and can be used together in a script
+    :param key: redis key
+    :return: shard key
+    """
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+
+    return key
+
+
+def hash_value(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+
+    """
+    Consistent hash ring, every node is placed at many points on the ring and a key belongs to the node
+    at the first point following its hash. Adding a node moves only the keys it takes over, ~1/N of them
+    """
+
+    def __init__(self, nodes, replicas=160):
+
+        """
+        :param nodes: list of (name, node) tuples, position of a node depends only on its name
+        :param replicas: points per node, more points spread the keys more evenly
+        """
+        self.nodes = [node for name, node in nodes]
+        points = []
+        for name, node in nodes:
+            for replica in xrange(replicas):
+                points.append((hash_value("%s#%d" % (name, replica)), node))
+        points.sort(key=lambda point: point[0])
+
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    def get(self, key):
+
+        """
+        Returns node owning the key
+        :param key: redis key
+        :return: node
+        """
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+
+        index = bisect.bisect(self._hashes, hash_value(shard_key(key)))
+        return self._nodes[index % len(self._nodes)]
@@ -1,19 +1,445 @@
+import multiprocessing
+import os
+import threading
+import time
+
 import redis
+from sqlalchemy import event, inspect
 from werkzeug import exceptions
 
-from models import Account, phone_number
-from config import REDIS_HOST, REDIS_PORT
+from app import app, db
+from cache import TTLCache, MISSING
+from limiter import Limiter, LimitResult, LocalLimiter, get_limiter, hit_many
+from breaker import CircuitBreaker, ServiceUnavailable
+from nearcache import StopNearCache
+from optout import StopRequestStore, flush_on_exit
+from bloom import ExpiringBloomFilter
+from sharding import HashRing
+from message import parse_message
+from credentials import secret_digest
+from quota import quota_policies
+from directory import number_directory
+from metrics import registry, stage_seconds, redis_pool_wait_seconds, redis_fallbacks_total, Gauge
+from models import Account, phone_number, QuotaTier, find_account_number
+from config import AUTH_CACHE_SIZE, AUTH_CACHE_TTL, AUTH_CACHE_NEGATIVE_TTL, DEFAULT_RATE_LIMITER, \
+    STOP_CACHE_ENABLED, STOP_CACHE_SIZE, STOP_CACHE_TTL, STOP_CHANNEL, STOP_FILTER_ENABLED, STOP_FILTER_PREFIX, \
+    STOP_FILTER_WINDOW, STOP_FILTER_BUCKETS, STOP_FILTER_CAPACITY, STOP_FILTER_ERROR_RATE, REDIS_BREAKER_FAILURES, \
+    REDIS_BREAKER_RESET_TIMEOUT, REDIS_FAILURE_POLICY, REDIS_FALLBACK_LIMIT_SHARE, STOP_SNAPSHOT_SIZE, \
+    STOP_PERSIST_ENABLED, STOP_PERSIST_INTERVAL, STOP_PERSIST_SIZE, STOP_PERSIST_PURGE_INTERVAL, STOP_RESTORE_MARKER, \
+    STOP_RESTORE_CHECK_INTERVAL, STOP_RESTORE_LOCK_TIMEOUT, STOP_RESTORE_BATCH_SIZE, USAGE_BATCH_ENABLED, \
+    SERVER_WORKERS, STOP_FILTER_RELOAD_JITTER, STOP_FILTER_RELOAD_INTERVAL
+
+# process wide redis connections by node, recreated in child processes after fork
+_redis_lock = threading.Lock()
+_redis_ring = None
+_redis_pid = None
+
+# (username, auth_id) => account id, None for invalid credentials
+account_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+# (account id, number) => True if the number belongs to the account
+number_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+# account id => rate limiter strategy
+limiter_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+
+class SingleFlight(object):
+
+    """
+    Coalesces concurrent identical calls, callers asking for a key while a call for it is in flight wait for
+    that call and share its result or exception instead of repeating it
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        # key => [event set once done, result, exception]
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+
+        """
+        :param key: hashable key identifying the call, equal keys must give equal results
+        :param func: function to be called
+        :param args: arguments of the function
+        :return: result of the function
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = [threading.Event(), None, None]
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight[0].wait()
+            if flight[2] is not None:
+                raise flight[2]
+            return flight[1]
+
+        try:
+            flight[1] = func(*args)
+            return flight[1]
+        except Exception as e:
+            flight[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight[0].set()
+
+
+class HitBatcher(object):
+
+    """
+    Group commits quota hits, a hit of a key with no script call in flight is applied right away. Hits of the key
+    arriving while a call is in flight queue up and are consumed together by a single atomic script call once it
+    returns, along with the stop request check of every hit which carries one. Allowed smses are handed out in
+    arrival order, so every caller gets the answer it would have got from its own call
+    """
+
+    def __init__(self, enabled=True):
+
+        """
+        :param enabled: every hit is applied on its own if False
+        """
+        self.enabled = enabled
+        self.batches = 0
+        self.batched = 0
+        # (strategy, key, limit, window) => call in flight, [event set once done,
+        # (stop key, from number) or None of every hit, LimitResult of every hit, exception, call queued behind it]
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def hit(self, limiter, client, key, limit, window, stop_key=None, from_number=None):
+
+        """
+        Checks quota and consumes a single sms
+        :param limiter: limiter of the strategy
+        :param client: redis connection
+        :param key: usage key
+        :param limit: maximum number of smses allowed in the window
+        :param window: window in seconds
+        :param stop_key: key under which stop request of the recipient is registered, on the node of the usage key
+        :param from_number: number that is sending the sms, stop request is checked only if it is given
+        :return: LimitResult of the caller
+        """
+        stop = (stop_key, from_number) if stop_key is not None and from_number else None
+        if not self.enabled:
+            return limiter.hit_each(client, key, limit, window, [stop])[0]
+
+        flight_key = (limiter.name, key, limit, window)
+        with self._lock:
+            previous = self._flights.get(flight_key)
+            if previous is None:
+                flight = self._flights[flight_key] = [threading.Event(), [], None, None, None]
+                leader = True
+            else:
+                flight = previous[4]
+                leader = flight is None
+                if leader:
+                    flight = previous[4] = [threading.Event(), [], None, None, None]
+            position = len(flight[1])
+            flight[1].append(stop)
+
+        if leader:
+            if previous is not None:
+                previous[0].wait()
+            # hits can no longer join once the previous call handed over, see _land
+            try:
+                flight[2] = limiter.hit_each(client, key, limit, window, flight[1])
+            except Exception as e:
+                flight[3] = e
+            finally:
+                self._land(flight_key, flight)
+        else:
+            flight[0].wait()
+
+        if flight[3] is not None:
+            raise flight[3]
+
+        return flight[2][position]
+
+    def _land(self, flight_key, flight):
+
+        """
+        Completes the call in flight, the call queued behind it becomes the one in flight
+        """
+        with self._lock:
+            if flight[4] is None:
+                del self._flights[flight_key]
+            else:
+                self._flights[flight_key] = flight[4]
+            self.batches += 1
+            self.batched += len(flight[1])
+        flight[0].set()
+
+
+single_flight = SingleFlight()
+hit_batcher = HitBatcher(USAGE_BATCH_ENABLED)
+
+
+class TimedConnectionPool(redis.BlockingConnectionPool):
+
+    """
+    Connection pool which records time spent waiting for a free connection
+    """
+
+    def get_connection(self, command_name, *keys, **options):
+        with redis_pool_wait_seconds.time():
+            return super(TimedConnectionPool, self).get_connection(command_name, *keys, **options)
+
+
+def get_redis_nodes():
+
+    """
+    Returns configured redis nodes
+    :return: list of dicts with host and port or unix_socket_path
+    """
+    config = app.config
+    if config["REDIS_NODES"]:
+        return config["REDIS_NODES"]
+
+    return [dict(host=config["REDIS_HOST"], port=config["REDIS_PORT"],
+                 unix_socket_path=config["REDIS_UNIX_SOCKET_PATH"])]
 
 
-def get_redis_connection():
+def create_redis_pool(node):
 
     """
-    Returns redis connection
+    Creates redis connection pool as per the app configuration
+    :param node: dict with host and port or unix_socket_path
+    :return: connection pool
+    """
+    config = app.config
+    kwargs = dict(db=node.get("db", config["REDIS_DB"]),
+                  max_connections=config["REDIS_MAX_CONNECTIONS"],
+                  timeout=config["REDIS_POOL_TIMEOUT"],
+                  socket_timeout=config["REDIS_SOCKET_TIMEOUT"],
+                  health_check_interval=config["REDIS_HEALTH_CHECK_INTERVAL"])
+
+    # blocking pool makes concurrent requests wait for a free connection instead of failing
+    if node.get("unix_socket_path"):
+        return TimedConnectionPool(connection_class=redis.UnixDomainSocketConnection,
+                                   path=node["unix_socket_path"], **kwargs)
+
+    return TimedConnectionPool(host=node["host"], port=node["port"],
+                               socket_connect_timeout=config["REDIS_SOCKET_CONNECT_TIMEOUT"], **kwargs)
+
+
+def get_redis_ring():
+
+    """
+    Returns hash ring of redis connections backed by the process wide connection pools.
+    A forked child process gets its own pools so sockets are never shared with the parent
+    :return: HashRing
+    """
+    global _redis_ring, _redis_pid
+
+    pid = os.getpid()
+    if _redis_pid != pid:
+        with _redis_lock:
+            if _redis_pid != pid:
+                nodes = []
+                for node in get_redis_nodes():
+                    name = node.get("unix_socket_path") or "%s:%s" % (node["host"], node["port"])
+                    nodes.append((name, redis.StrictRedis(connection_pool=create_redis_pool(node))))
+                _redis_ring = HashRing(nodes)
+                _redis_pid = pid
+
+    return _redis_ring
+
+
+def get_redis_connection(key=None):
+
+    """
+    Returns redis connection of the node owning the key
+    :param key: redis key, connection of the first node is returned if not given
     :return:
     """
-    return redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+    ring = get_redis_ring()
+    if key is None:
+        return ring.nodes[0]
 
+    return ring.get(key)
 
+
+def get_redis_connections():
+
+    """
+    Returns connections of all the redis nodes
+    :return: list of connections
+    """
+    return list(get_redis_ring().nodes)
+
+
+def group_by_node(keys):
+
+    """
+    Groups keys by the redis node owning them
+    :param keys: iterable of redis keys
+    :return: list of (connection, keys) tuples
+    """
+    groups = {}
+    for key in keys:
+        redis_conn = get_redis_connection(key)
+        groups.setdefault(id(redis_conn), (redis_conn, []))[1].append(key)
+
+    return list(groups.values())
+
+
+def reset_redis_connection():
+
+    """
+    Drops the process wide connection pools, next call to get_redis_connection will create new ones.
+    Parent sockets are left untouched so it is safe to call right after fork
+    :return: No return
+    """
+    global _redis_ring, _redis_pid
+
+    with _redis_lock:
+        _redis_ring = None
+        _redis_pid = None
+
+
+# stop requests cached per process, kept in sync through STOP_CHANNEL
+stop_filter = None
+if STOP_FILTER_ENABLED:
+    stop_filter = ExpiringBloomFilter(STOP_FILTER_WINDOW, STOP_FILTER_BUCKETS, STOP_FILTER_CAPACITY,
+                                      STOP_FILTER_ERROR_RATE)
+# every stop request seen by this process, consulted only while redis is unavailable
+stop_snapshot = TTLCache(STOP_SNAPSHOT_SIZE, STOP_FILTER_WINDOW)
+stop_cache = StopNearCache(STOP_CACHE_SIZE, STOP_CACHE_TTL, STOP_CHANNEL, get_redis_connection,
+                           get_redis_connections, enabled=STOP_CACHE_ENABLED, stop_filter=stop_filter, filter_prefix=STOP_FILTER_PREFIX,
+                           snapshot=stop_snapshot, reload_jitter=STOP_FILTER_RELOAD_JITTER,
+                           reload_interval=STOP_FILTER_RELOAD_INTERVAL)
+
+# stop requests persisted to postgres, restored into redis nodes which lost them
+stop_store = StopRequestStore(get_redis_connection, get_redis_connections, STOP_RESTORE_MARKER, STOP_PERSIST_INTERVAL,
+                              STOP_PERSIST_SIZE, STOP_PERSIST_PURGE_INTERVAL, STOP_RESTORE_CHECK_INTERVAL,
+                              STOP_RESTORE_LOCK_TIMEOUT, STOP_RESTORE_BATCH_SIZE, enabled=STOP_PERSIST_ENABLED)
+stop_store.on_restore.append(lambda: stop_cache.publish_reload(get_redis_connection()))
+flush_on_exit(stop_store)
+
+# degraded mode, checks are answered from in process state while redis is unavailable
+redis_breaker = CircuitBreaker("redis", REDIS_BREAKER_FAILURES, REDIS_BREAKER_RESET_TIMEOUT)
+local_limiter = LocalLimiter(REDIS_FALLBACK_LIMIT_SHARE or 1.0 / (SERVER_WORKERS or multiprocessing.cpu_count()))
+# stop requests registered while redis was unavailable, list of (key, value, expires at)
+pending_stop_requests = []
+_pending_lock = threading.Lock()
+
+
+def count_fallback(name):
+    redis_fallbacks_total.inc((name,))
+
+
+def degraded_register_stop_request(text, key, value, expiry):
+
+    """
+    Applies stop request to this process, it is registered in redis once redis is back
+    """
+    if text.strip() == "STOP":
+        stop_cache.invalidate(key, value, expiry)
+        stop_store.record(key, value, expiry)
+        with _pending_lock:
+            pending_stop_requests.append((key, value, time.time() + expiry))
+
+
+def degraded_register_stop_requests(requests, expiry):
+    for text, key, value in requests:
+        degraded_register_stop_request(text, key, value, expiry)
+
+
+def degraded_check_stop_request(key, from_number):
+
+    """
+    Checks the last known stop requests, unknown numbers are rejected if stop policy is "closed"
+    """
+    value = stop_snapshot.get(key)
+    if value is MISSING and REDIS_FAILURE_POLICY["stop"] == "closed":
+        raise ServiceUnavailable()
+
+    if value == from_number:
+        return "sms from %s to %s blocked by STOP request"
+    return None
+
+
+def degraded_check_stop_requests(requests):
+    return [degraded_check_stop_request(key, from_number) for key, from_number in requests]
+
+
+def degraded_usage(strategy, key, limit, timeout, count=1):
+
+    """
+    Applies usage policy while redis is unavailable
+    :return: LimitResult
+    """
+    policy = REDIS_FAILURE_POLICY["usage"]
+    if policy == "closed":
+        raise ServiceUnavailable()
+    if policy == "open":
+        return LimitResult(count, False, limit, limit, timeout, 0)
+
+    return local_limiter.hit(strategy or DEFAULT_RATE_LIMITER, key, limit, timeout, count)
+
+
+def degraded_update_usage(key, limit, timeout, strategy=None, stop_key=None, from_number=None):
+    if stop_key is not None and degraded_check_stop_request(stop_key, from_number):
+        return Limiter.blocked(limit)
+
+    return degraded_usage(strategy, key, limit, timeout)
+
+
+def degraded_update_usage_batch(requested, limit, timeout, strategies=None, policies=None):
+    allowed = {}
+    for key, count in requested.items():
+        key_limit, key_timeout = (policies or {}).get(key, (limit, timeout))
+        allowed[key] = degraded_usage((strategies or {}).get(key), key, key_limit, key_timeout, count).allowed
+
+    return allowed
+
+
+def reconcile_redis():
+
+    """
+    Adds usage granted and stop requests registered while redis was unavailable, whatever could not be added
+    is kept for the next recovery
+    :return: No return
+    """
+    granted = local_limiter.drain()
+    with _pending_lock:
+        stop_requests = pending_stop_requests[:]
+        del pending_stop_requests[:]
+
+    try:
+        for (strategy, key, limit, window), count in granted.items():
+            # quota exhausted by other processes meanwhile stays exhausted, the limiter caps the count
+            get_limiter(strategy).hit(get_redis_connection(key), key, limit, window, count=count)
+            del granted[(strategy, key, limit, window)]
+
+        while stop_requests:
+            key, value, expires = stop_requests[0]
+            if expires > time.time():
+                register_stop_request("STOP", key, value, max(int(expires - time.time()), 1))
+            stop_requests.pop(0)
+    except Exception as e:
+        print e
+        local_limiter.restore(granted)
+        with _pending_lock:
+            pending_stop_requests.extend(stop_requests)
+
+
+redis_breaker.on_recover.append(reconcile_redis)
+# redis coming back after an outage may have lost the stop requests, e.g. a replica promoted meanwhile
+redis_breaker.on_recover.append(stop_store.restore)
+registry.register(Gauge("sms_redis_circuit_open", "1 while redis calls are skipped by the circuit breaker", (),
+                        lambda: [((), int(redis_breaker.is_open))]))
+
+
+@stage_seconds.timed(("register_stop",))
+@redis_breaker.fallback(degraded_register_stop_request, count_fallback)
 def register_stop_request(text, key, value, expiry):
 
     """
@@ -25,12 +451,58 @@ def register_stop_request(text, key, value, expiry):
     :return: No return
     """
     if text.strip() == "STOP":
-        r = get_redis_connection()
+        stop_conn = get_redis_connection(key)
+        channel_conn = get_redis_connection()
+
+        # set expiry time as 4 hours and let all the processes know about it
+        pipe = stop_conn.pipeline()
+        pipe.set(key, value, ex=expiry)
+        if stop_conn is channel_conn:
+            stop_cache.publish(pipe, key, value, expiry)
+            pipe.execute()
+        else:
+            pipe.execute()
+            stop_cache.publish(channel_conn, key, value, expiry)
+
+        stop_cache.invalidate(key, value, expiry)
+        stop_store.record(key, value, expiry)
+
+
+@stage_seconds.timed(("register_stop_batch",))
+@redis_breaker.fallback(degraded_register_stop_requests, count_fallback)
+def register_stop_requests(requests, expiry):
+
+    """
+    Batch version of register_stop_request, all the stop requests are written in a single pipelined round trip
+    per redis node, and announced on the stop request channel afterwards
+    :param requests: list of (text, key, value) tuples
+    :param expiry: expiry in seconds
+    :return: number of stop requests registered
+    """
+
+    registered = dict((key, value) for text, key, value in requests if text.strip() == "STOP")
+
+    for redis_conn, keys in group_by_node(registered):
+        pipe = redis_conn.pipeline()
+        for key in keys:
+            pipe.set(key, registered[key], ex=expiry)
+        pipe.execute()
+
+    if registered:
+        pipe = get_redis_connection().pipeline(transaction=False)
+        for key, value in registered.items():
+            stop_cache.publish(pipe, key, value, expiry)
+        pipe.execute()
 
-        # set expiry time as 4 hours
-        r.set(key, value, ex=expiry)
+    for key, value in registered.items():
+        stop_cache.invalidate(key, value, expiry)
+        stop_store.record(key, value, expiry)
 
+    return len(registered)
 
+
+@stage_seconds.timed(("stop_check",))
+@redis_breaker.fallback(degraded_check_stop_request, count_fallback)
 def check_stop_request(key, from_number):
 
     """
@@ -40,15 +512,190 @@ def check_stop_request(key, from_number):
     :return: error statement if stop request is registered else none
     """
 
-    # check if stop request is registered in redis
+    # check if stop request is registered, redis is consulted only if it is not cached.
+    # only reads started since the last stop request seen by this process are shared, an older one may miss it
     error = None
-    r = get_redis_connection()
-    if r.get(key) == from_number:
+    value = stop_cache.get(key)
+    if value is MISSING:
+        value = single_flight.do(("stop", key, stop_cache.generation), fetch_stop_request, key)
+
+    if value == from_number:
         error = "sms from %s to %s blocked by STOP request"
 
     return error
 
 
+def get_account_id(username, auth_id):
+
+    """
+    Returns id of the account matching the credentials, lookups are cached
+    :param username: account username
+    :param auth_id: account auth id
+    :return: account id or None if credentials are invalid
+    """
+
+    key = (username, secret_digest(auth_id))
+    account_id = account_cache.get(key)
+    if account_id is MISSING:
+        account_id = single_flight.do(("account",) + key, find_account_id, username, auth_id)
+        account_cache.set(key, account_id, AUTH_CACHE_TTL if account_id else AUTH_CACHE_NEGATIVE_TTL)
+
+    return account_id
+
+
+def find_account_id(username, auth_id):
+    for account_obj in Account.query.filter_by(username=username):
+        if account_obj.check_auth_id(auth_id):
+            return account_obj.id
+
+    return None
+
+
+def is_number_owned(account_id, number):
+
+    """
+    Checks if number belongs to the account, answered by the number directory when it knows the number
+    otherwise lookups are cached
+    :param account_id: account id
+    :param number: phone number
+    :return: True if number belongs to the account
+    """
+
+    if number_directory.contains(account_id, number):
+        return True
+
+    key = (account_id, "%s" % number)
+    owned = number_cache.get(key)
+    if owned is MISSING:
+        owned = single_flight.do(("number",) + key, find_number, account_id, number)
+        number_cache.set(key, owned, AUTH_CACHE_TTL if owned else AUTH_CACHE_NEGATIVE_TTL)
+
+    return owned
+
+
+def find_number(account_id, number):
+    return phone_number.query.filter_by(number=number, account_id=account_id).first() is not None
+
+
+@stage_seconds.timed(("authenticate",))
+def resolve_account(username, auth_id, number):
+
+    """
+    Authenticates the account and checks if number belongs to it.
+    Answered from the caches when possible otherwise both are resolved by a single query
+    :param username: account username
+    :param auth_id: account auth id
+    :param number: phone number
+    :return: tuple of account id (None if credentials are invalid) and True if number belongs to the account
+    """
+
+    account_key = (username, secret_digest(auth_id))
+    account_id = account_cache.get(account_key)
+    if account_id is None:
+        return None, False
+
+    if account_id is not MISSING:
+        if number_directory.contains(account_id, number):
+            return account_id, True
+        owned = number_cache.get((account_id, "%s" % number))
+        if owned is not MISSING:
+            return account_id, owned
+
+    with stage_seconds.time(("authenticate_query",)):
+        account_id, owned = single_flight.do(("account_number",) + account_key + ("%s" % number,),
+                                             find_account_number, username, auth_id, number)
+    if account_id is None:
+        account_cache.set(account_key, None, AUTH_CACHE_NEGATIVE_TTL)
+    else:
+        account_cache.set(account_key, account_id)
+        number_cache.set((account_id, "%s" % number), owned, AUTH_CACHE_TTL if owned else AUTH_CACHE_NEGATIVE_TTL)
+
+    return account_id, owned
+
+
+def fetch_stop_request(key):
+
+    """
+    Reads stop request from redis and caches it
+    :param key: stop key
+    :return: stop value or None
+    """
+    generation = stop_cache.generation
+    pipe = get_redis_connection(key).pipeline(transaction=False)
+    value, ttl = pipe.get(key).ttl(key).execute()
+    stop_cache.set(key, value, generation, ttl)
+    return value
+
+
+@stage_seconds.timed(("stop_check_batch",))
+@redis_breaker.fallback(degraded_check_stop_requests, count_fallback)
+def check_stop_requests(requests):
+
+    """
+    Batch version of check_stop_request for smses about to be sent. Only stop requests found in the near cache are
+    served from it, a cached negative may miss a stop request whose invalidation is still on the way, so all the
+    other keys are read in a single round trip per redis node
+    :param requests: list of (key, from_number) tuples
+    :return: list with error statement for every blocked request otherwise None
+    """
+
+    values = {}
+    for key, from_number in requests:
+        if key not in values or values[key] is MISSING:
+            value = stop_cache.get(key)
+            values[key] = value if value == from_number else MISSING
+    missing = [key for key in values if values[key] is MISSING]
+    generation = stop_cache.generation
+    for redis_conn, keys in group_by_node(missing):
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.mget(keys)
+        for key in keys:
+            pipe.ttl(key)
+        result = pipe.execute()
+
+        for key, value, ttl in zip(keys, result[0], result[1:]):
+            values[key] = value
+            stop_cache.set(key, value, generation, ttl)
+
+    errors = []
+    for key, from_number in requests:
+        errors.append("sms from %s to %s blocked by STOP request" if values[key] == from_number else None)
+
+    return errors
+
+
+@stage_seconds.timed(("usage_batch",))
+@redis_breaker.fallback(degraded_update_usage_batch, count_fallback)
+def update_usage_batch(requested, limit, timeout, strategies=None, policies=None):
+
+    """
+    Batch version of update_usage, usage of all the keys is updated in a single pipelined round trip per redis node
+    :param requested: dict of key => number of smses to be sent
+    :param limit: maximum number of smses allowed in the window for every key
+    :param timeout: window in seconds
+    :param strategies: dict of key => rate limiter strategy, DEFAULT_RATE_LIMITER is used for missing keys
+    :param policies: dict of key => (limit, window) overriding limit and timeout
+    :return: dict of key => number of smses allowed, remaining ones have crossed the limit
+    """
+
+    if not requested:
+        return {}
+
+    strategies = strategies or {}
+    policies = policies or {}
+    allowed = {}
+    for redis_conn, keys in group_by_node(requested):
+        hits = []
+        for key in keys:
+            key_limit, key_timeout = policies.get(key, (limit, timeout))
+            hits.append((get_limiter(strategies.get(key) or DEFAULT_RATE_LIMITER), key, key_limit, key_timeout,
+                         requested[key]))
+        results = hit_many(redis_conn, hits)
+        allowed.update((key, result.allowed) for key, result in zip(keys, results))
+
+    return allowed
+
+
 def authenticate_account(request, number):
 
     """
@@ -62,58 +709,239 @@ def authenticate_account(request, number):
     username = request.get('username', None)
     auth_id = request.get('password', None)
 
-    # authenticate the request
-    account_obj = Account.query.filter_by(auth_id=auth_id, username=username).first()
-    if not account_obj:
+    # authenticate the request and check if number belongs to the particular account
+    account_id, owned = resolve_account(username, auth_id, number)
+    if not account_id:
         raise exceptions.Forbidden()
 
-    # check if number belongs to the particular account
-    number_object = phone_number.query.filter_by(number=number, account_id=account_obj.id).first()
-    if not number_object:
+    if not owned:
         error = "%s parameter not found"
 
     return error
 
 
+def get_account_limiter(account_id):
+
+    """
+    Returns rate limiter strategy configured for the account, lookups are cached
+    :param account_id: account id
+    :return: strategy name
+    """
+
+    strategy = limiter_cache.get(account_id)
+    if strategy is MISSING:
+        strategy = single_flight.do(("limiter", account_id), find_account_limiter, account_id)
+        limiter_cache.set(account_id, strategy)
+
+    return strategy
+
+
+def find_account_limiter(account_id):
+    row = db.session.query(Account.rate_limiter).filter_by(id=account_id).first()
+    return (row and row[0]) or DEFAULT_RATE_LIMITER
+
+
+def invalidate_account(username, auth_id):
+
+    """
+    Removes cached authentication result of the credentials
+    :param username: account username
+    :param auth_id: account auth id
+    :return: No return
+    """
+    account_cache.invalidate((username, secret_digest(auth_id)))
+
+
+def invalidate_number(account_id, number):
+
+    """
+    Removes cached ownership result of the number
+    :param account_id: account id
+    :param number: phone number
+    :return: No return
+    """
+    number_cache.invalidate((account_id, "%s" % number))
+
+
+def collect_cache_stats():
+
+    """
+    Returns lookup counters of all the in process caches
+    :return: list of ((cache, result), count)
+    """
+    stats = []
+    for name, cache in [("account", account_cache), ("number", number_cache), ("limiter", limiter_cache),
+                        ("stop", stop_cache.cache)]:
+        stats.append(((name, "hit"), cache.hits))
+        stats.append(((name, "miss"), cache.misses))
+    stats.append((("stop_filter", "hit"), stop_cache.filter_negatives))
+    stats.append((("directory", "hit"), number_directory.hits))
+    stats.append((("directory", "miss"), number_directory.misses))
+    stats.append((("single_flight", "call"), single_flight.calls))
+    stats.append((("single_flight", "shared"), single_flight.shared))
+
+    return stats
+
+
+registry.register(Gauge("sms_cache_lookups_total", "Lookups of the in process caches by result",
+                        ("cache", "result"), collect_cache_stats, type="counter"))
+registry.register(Gauge("sms_stop_cache", "Stop request cache and filter statistics", ("stat",),
+                        lambda: [((name,), value) for name, value in sorted(stop_cache.stats().items())]))
+registry.register(Gauge("sms_quota_batches_total", "Quota hits applied in batches", ("stat",),
+                        lambda: [(("batches",), hit_batcher.batches), (("hits",), hit_batcher.batched)],
+                        type="counter"))
+registry.register(Gauge("sms_stop_request_store", "Persisted stop requests and restore statistics", ("stat",),
+                        lambda: [((name,), value) for name, value in sorted(stop_store.stats().items())]))
+registry.register(Gauge("sms_number_directory", "Number directory statistics", ("stat",),
+                        lambda: [((name,), value) for name, value in sorted(number_directory.stats().items())]))
+
+
+# keep the caches in sync with changes done through this process, other processes catch up on ttl expiry
+@event.listens_for(Account, 'after_insert')
+def _account_inserted(mapper, connection, target):
+    # auth id of the new account is not known here, drop failed lookups of its username instead
+    account_cache.clear()
+    if target.quota_tier_id:
+        quota_policies.invalidate()
+
+
+@event.listens_for(Account, 'after_update')
+@event.listens_for(Account, 'after_delete')
+def _account_changed(mapper, connection, target):
+    account_cache.clear()
+    limiter_cache.invalidate(target.id)
+    number_cache.clear()
+    quota_policies.invalidate()
+
+
+@event.listens_for(phone_number, 'after_insert')
+def _number_inserted(mapper, connection, target):
+    invalidate_number(target.account_id, target.number)
+    if target.quota_tier_id:
+        quota_policies.invalidate()
+
+
+@event.listens_for(phone_number, 'after_update')
+def _number_changed(mapper, connection, target):
+    # only the previous owner is dropped from the directory, the new one reaches it like an added number
+    number_cache.clear()
+    previous = []
+    for name in ("account_id", "number"):
+        deleted = inspect(target).attrs[name].history.deleted
+        previous.append(deleted[0] if deleted else getattr(target, name))
+    if previous != [target.account_id, target.number]:
+        number_directory.discard(*previous)
+    quota_policies.invalidate()
+
+
+@event.listens_for(phone_number, 'after_delete')
+def _number_deleted(mapper, connection, target):
+    # new numbers reach the directory once committed, removals are safe to apply right away
+    number_cache.clear()
+    number_directory.discard(target.account_id, target.number)
+    quota_policies.invalidate()
+
+
+@event.listens_for(QuotaTier, 'after_update')
+@event.listens_for(QuotaTier, 'after_delete')
+def _quota_tier_changed(mapper, connection, target):
+    quota_policies.invalidate()
+
+
 def validate_input(request):
 
     """
     Checks for mandatory parameters and  validates each parameter
     :param request: contains the request data
-    :return: it returns error if any otherwise it returns an account object
-    """
-
-    # Get all the mandatory parameter from request
-    from_number = request.get('from', None)
-    to_number = request.get('to', None)
-    text = request.get('text', None)
-
-    result = None
-    # check if all the parameters are present
-    error = "parameter '%s' is missing"
-    if not from_number:
-        result = error % "from"
-    if not to_number:
-        result = error % "to"
-    if not text:
-        result = error % "text"
-
-    # return error message if any parameter is missing
-    if result:
-        return result
-
-    # check validity of each input
-    error = "parameter '%s' is invalid"
-    if not (6 <= len(from_number) <= 16):
-        result = error % "from"
-    if not (6 <= len(to_number) <= 16):
-        result = error % "to"
-    if not (1 <= len(text) <= 120):
-        result = error % "text"
+    :return: it returns error if any otherwise None
+    """
+
+    return parse_message(request)[1]
+
+
+@stage_seconds.timed(("usage",))
+@redis_breaker.fallback(degraded_update_usage, count_fallback)
+def update_usage(key, limit, timeout, strategy=None, stop_key=None, from_number=None):
+
+    """
+    Checks for usage limit and updates the usage as per the rate limiter strategy, concurrent hits of the key
+    are batched by hit_batcher.
+    If stop_key and from_number are given stop request is checked in the same round trip and
+    usage is updated only if the sms is not blocked
+    :param key: usage key of the number that is sending the sms
+    :param limit: maximum number of smses allowed in the window
+    :param timeout: window in seconds
+    :param strategy: rate limiter strategy, defaults to DEFAULT_RATE_LIMITER
+    :param stop_key: key under which stop request of the recipient is registered
+    :param from_number: number that is sending the sms
+    :return: LimitResult
+    """
+
+    limiter = get_limiter(strategy or DEFAULT_RATE_LIMITER)
+    redis_conn = get_redis_connection(key)
+    if stop_key is None:
+        return hit_batcher.hit(limiter, redis_conn, key, limit, timeout)
+
+    # a cached stop request blocks the sms right away, a cached negative may miss a stop request whose
+    # invalidation is still on the way so the script checks it anyway
+    value = stop_cache.get(stop_key)
+    if value == from_number:
+        return Limiter.blocked(limit)
+
+    # stop request lives on another node, read it before touching the usage
+    if get_redis_connection(stop_key) is not redis_conn:
+        if single_flight.do(("stop", stop_key, stop_cache.generation), fetch_stop_request, stop_key) == from_number:
+            return Limiter.blocked(limit)
+        return hit_batcher.hit(limiter, redis_conn, key, limit, timeout)
+
+    # the script checks the stop request atomically along with the quota of the concurrent hits of the key
+    generation = stop_cache.generation
+    result = hit_batcher.hit(limiter, redis_conn, key, limit, timeout, stop_key, from_number)
+    if result.blocked:
+        stop_cache.set(stop_key, from_number, generation)
 
     return result
 
 
+@redis_breaker.fallback(local_limiter.refund, count_fallback)
+def refund_usage(strategy, key, limit, timeout, count=1):
+
+    """
+    Gives back quota consumed by update_usage for smses which could not be queued
+    :param strategy: rate limiter strategy
+    :param key: usage key of the number that is sending the sms
+    :param limit: maximum number of smses allowed in the window
+    :param timeout: window in seconds
+    :param count: number of smses to give back
+    :return: No return
+    """
+    if count > 0:
+        get_limiter(strategy or DEFAULT_RATE_LIMITER).refund(get_redis_connection(key), key, limit, timeout, count)
+
+
+def check_stop_and_usage(stop_key, from_number, usage_key, limit, timeout):
+
+    """
+    Checks stop request and usage limit together in a single round trip to redis.
+    Usage is updated only if the sms is not blocked by stop request
+    :param stop_key: key under which stop request of the recipient is registered
+    :param from_number: number that is sending the sms
+    :param usage_key: key under which usage of from_number is counted
+    :param limit: maximum number of smses allowed in the window
+    :param timeout: seconds after which counter will be reset
+    :return: tuple of stop error and usage error, at most one of them is set
+    """
+
+    result = update_usage(usage_key, limit, timeout, "fixed_window", stop_key, from_number)
+
+    if result.blocked:
+        return "sms from %s to %s blocked by STOP request", None
+    if not result.allowed:
+        return None, "limit reached for from %s"
+
+    return None, None
+
+
 def check_and_update_usage(key, limit, timeout):
 
     """
@@ -125,32 +953,8 @@ def check_and_update_usage(key, limit, timeout):
     :return: Error statement if usage limit has been crossed
     """
 
-    redis_conn = get_redis_connection()
-
-    # lock the section so that multiple simultaneous request get correct count
-    lock = redis_conn.lock("OUTBOUND", sleep=0.1, thread_local=True, timeout=10)
-    # critical section starts
-    lock.acquire()
-
-    # check if the limit has crossed in last 24 hours
-    count = redis_conn.get(key)
-
-    if not count:
-        # for expired/first time set expiry as 24 hours and count as 1
-        redis_conn.set(key, 1, timeout)
-    else:
-        count = int(count)
-        if count >= limit:
-            return "limit reached for from %s"
-        else:
-            # increment the count and set the expiry timer to previous value
-            ttl = redis_conn.pttl(key)
-            redis_conn.psetex(key, ttl, count + 1)
-
-    # critical section over
-    lock.release()
+    # check and increment happen atomically inside redis, so no lock is needed
+    if not update_usage(key, limit, timeout, "fixed_window").allowed:
+        return "limit reached for from %s"
 
     return None
-
-
-
@@ -1,83 +1,390 @@
+import functools
+import hmac
+import time
+
 from app import app
-from flask import request, jsonify
+from flask import g, request, jsonify, Response
 from utils import *
+from config import BATCH_SIZE_LIMIT, DISPATCH_ENABLED, DEFAULT_SMS_LIMIT, DEFAULT_SMS_WINDOW
+from dispatch import enqueue_outbound, enqueue_outbound_batch
+from idempotency import idempotent
+from message import parse_message, request_data, get_parameter, normalize_number
+from provisioning import provision
+from accounting import usage_recorder, query_usage, PERIODS
+from quota import quota_policies
+from breaker import ServiceUnavailable
+from metrics import registry, request_seconds, requests_total, error_category
 
 IN_PREFIX = "INBOUND_"
 OUT_PREFIX = "OUTBOUND_"
-SMS_LIMIT = 50
 HOUR = 3600
 
 
+def respond(error, **kwargs):
+
+    """
+    Returns json response of the api, its error is kept on flask.g for the request metrics
+    :param error: error statement, "" if the request succeeded
+    :return: response
+    """
+    g.error = error
+    return jsonify(error=error, **kwargs)
+
+
+def instrumented(endpoint):
+
+    """
+    Records duration and result category of every request handled by the view,
+    the category is taken from the error the view responded with
+    :param endpoint: endpoint name used as metric label
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with request_seconds.time((endpoint,)):
+                try:
+                    response = view(*args, **kwargs)
+                except exceptions.Forbidden:
+                    requests_total.inc((endpoint, "forbidden"))
+                    raise
+
+            requests_total.inc((endpoint, error_category(g.get("error"))))
+            return response
+        return wrapper
+    return decorator
+
+
 @app.route('/inbound/sms/', methods=['POST'])
+@instrumented("inbound")
+@idempotent("inbound")
 def inbound():
 
     try:
-        # check and validate all the input
-        error = validate_input(request.form)
+        # parse and validate all the input once
+        sms, error = parse_message(request_data(request))
         if error:
-            return jsonify(error=error, message="")
-
-        to_number = request.form["to"]
-        text = request.form["text"]
-        from_number = request.form["from"]
+            return respond(error=error, message="")
 
         # authenticate the request
-        error = authenticate_account(request.form, to_number)
-        if error:
-            error %= "to"
-            return jsonify(error=error, message="")
+        account_id, owned = resolve_account(sms.username, sms.password, sms.to_number)
+        if not account_id:
+            raise exceptions.Forbidden()
+        if not owned:
+            return respond(error="to parameter not found", message="")
 
         # check if stop request was raised and set same in redis
-        register_stop_request(text, IN_PREFIX + from_number, to_number, 4 * HOUR)
+        register_stop_request(sms.text, IN_PREFIX + sms.from_number, sms.to_number, 4 * HOUR)
+        usage_recorder.record(account_id, sms.to_number, "inbound")
 
         # all is well
         error = ""
         message = "inbound sms ok"
-        return jsonify(error=error, message=message)
+        return respond(error=error, message=message)
 
     except exceptions.Forbidden as e:
         raise e
+    except ServiceUnavailable as e:
+        return respond(error=str(e), message="")
     except Exception as e:
         print e
         error = "unknown failure"
-        return jsonify(error=error, message="")
+        return respond(error=error, message="")
 
 
 @app.route('/outbound/sms/', methods=['POST'])
+@instrumented("outbound")
+@idempotent("outbound")
 def outbound():
     try:
-        # check and validates all the input
-        error = validate_input(request.form)
+        # parse and validate all the input once
+        sms, error = parse_message(request_data(request))
         if error:
-            return jsonify(error=error, message="")
+            return respond(error=error, message="")
 
-        from_number = request.form["from"]
-        to_number = request.form["to"]
+        from_number = sms.from_number
+        to_number = sms.to_number
 
         # authenticate the request
-        error = authenticate_account(request.form, from_number)
-        if error:
-            error %= "from"
-            return jsonify(error=error, message="")
+        account_id, owned = resolve_account(sms.username, sms.password, from_number)
+        if not account_id:
+            raise exceptions.Forbidden()
+        if not owned:
+            return respond(error="from parameter not found", message="")
 
-        # check if stop request is registered in redis
-        error = check_stop_request(IN_PREFIX + to_number, from_number)
-        if error:
-            error %= (from_number, to_number)
-            return jsonify(error=error, meessage="")
+        # check if stop request is registered and usage limit has been crossed, in one go
+        limit, window = quota_policies.get(account_id, from_number)
+        strategy = get_account_limiter(account_id)
+        result = update_usage(OUT_PREFIX + from_number, limit, window, strategy, IN_PREFIX + to_number, from_number)
+        if result.blocked:
+            error = "sms from %s to %s blocked by STOP request" % (from_number, to_number)
+            return respond(error=error, meessage="")
 
-        # check if usage limit has been crossed
-        error = check_and_update_usage(OUT_PREFIX + from_number, SMS_LIMIT, 24*HOUR)
-        if error:
-            error %= from_number
-            return jsonify(error=error, message="")
+        if not result.allowed:
+            error = "limit reached for from %s" % from_number
+            return add_rate_limit_headers(respond(error=error, message=""), result)
+
+        # queue the sms for delivery
+        if DISPATCH_ENABLED:
+            error = enqueue_outbound(account_id, from_number, to_number, sms.text)
+            if error:
+                # the sms is refused, so it must not use up the quota of the retries
+                refund_usage(strategy, OUT_PREFIX + from_number, limit, window)
+                return add_rate_limit_headers(respond(error=error, message=""), result._replace(
+                    remaining=result.remaining + 1))
+        usage_recorder.record(account_id, from_number, "outbound")
 
         # all is well
         message = "outbound sms ok"
-        return jsonify(error="", message=message)
+        return add_rate_limit_headers(respond(error="", message=message), result)
 
     except exceptions.Forbidden as e:
         raise e
+    except ServiceUnavailable as e:
+        return respond(error=str(e), message="")
+    except Exception as e:
+        print e
+        return respond(error="unknown failure", message="")
+
+
+def add_rate_limit_headers(response, result):
+
+    """
+    Adds remaining quota and reset time to the response so that clients can back off
+    :param response: outgoing response
+    :param result: LimitResult of the sender
+    :return: response
+    """
+
+    response.headers["X-RateLimit-Limit"] = str(result.limit)
+    response.headers["X-RateLimit-Remaining"] = str(result.remaining)
+    response.headers["X-RateLimit-Reset"] = str(result.reset)
+    if not result.allowed:
+        response.headers["Retry-After"] = str(result.retry_after)
+
+    return response
+
+
+def get_batch(request):
+
+    """
+    Returns list of messages posted as json array
+    :param request: incoming request
+    :return: tuple of messages and error, messages which are not json objects are replaced by empty ones
+    """
+
+    messages = request.get_json(force=True, silent=True)
+    if not isinstance(messages, list) or not messages:
+        return None, "batch must be a non empty json array"
+    if len(messages) > BATCH_SIZE_LIMIT:
+        return None, "batch size must not exceed %s" % BATCH_SIZE_LIMIT
+
+    return [message if isinstance(message, dict) else {} for message in messages], None
+
+
+@app.route('/inbound/sms/batch/', methods=['POST'])
+@instrumented("inbound_batch")
+@idempotent("inbound_batch")
+def inbound_batch():
+    try:
+        messages, error = get_batch(request)
+        if error:
+            return respond(error=error, message="")
+
+        results = [None] * len(messages)
+        stop_requests = []
+        received = []
+        authenticated = {}
+        for index, message in enumerate(messages):
+            # parse and validate all the input once
+            sms, error = parse_message(message)
+            if error:
+                results[index] = dict(error=error, message="")
+                continue
+
+            # authenticate once for every distinct account and to number
+            key = sms.credentials + (sms.to_number,)
+            if key not in authenticated:
+                authenticated[key] = resolve_account(*key)
+
+            account_id, owned = authenticated[key]
+            if not account_id:
+                results[index] = dict(error="403 Forbidden", message="")
+            elif not owned:
+                results[index] = dict(error="to parameter not found", message="")
+            else:
+                stop_requests.append((sms.text, IN_PREFIX + sms.from_number, sms.to_number))
+                received.append((account_id, sms.to_number))
+                results[index] = dict(error="", message="inbound sms ok")
+
+        # register all the stop requests in one go
+        register_stop_requests(stop_requests, 4 * HOUR)
+        for account_id, to_number in received:
+            usage_recorder.record(account_id, to_number, "inbound")
+
+        return respond(error="", message="inbound sms batch ok", results=results)
+
+    except ServiceUnavailable as e:
+        return respond(error=str(e), message="")
     except Exception as e:
         print e
-        return jsonify(error="unknown failure", message="")
+        return respond(error="unknown failure", message="")
+
+
+@app.route('/outbound/sms/batch/', methods=['POST'])
+@instrumented("outbound_batch")
+@idempotent("outbound_batch")
+def outbound_batch():
+    try:
+        messages, error = get_batch(request)
+        if error:
+            return respond(error=error, message="")
+
+        results = [None] * len(messages)
+        accepted = []
+        authenticated = {}
+        for index, message in enumerate(messages):
+            # parse and validate all the input once, parsed smses replace the posted ones
+            sms, error = parse_message(message)
+            if error:
+                results[index] = dict(error=error, message="")
+                continue
+            messages[index] = sms
+
+            # authenticate once for every distinct account and from number
+            key = sms.credentials + (sms.from_number,)
+            if key not in authenticated:
+                authenticated[key] = resolve_account(*key)
+
+            account_id, owned = authenticated[key]
+            if not account_id:
+                results[index] = dict(error="403 Forbidden", message="")
+            elif not owned:
+                results[index] = dict(error="from parameter not found", message="")
+            else:
+                accepted.append(index)
+
+        # check stop requests of all the recipients in one go
+        errors = check_stop_requests([(IN_PREFIX + messages[index].to_number, messages[index].from_number)
+                                      for index in accepted])
+        allowed = []
+        for index, error in zip(accepted, errors):
+            if error:
+                results[index] = dict(error=error % (messages[index].from_number, messages[index].to_number),
+                                      message="")
+            else:
+                allowed.append(index)
+
+        # update usage of all the senders in one go, smses are allowed in the order they were posted
+        requested = {}
+        strategies = {}
+        senders = {}
+        policies = {}
+        for index in allowed:
+            sms = messages[index]
+            key = OUT_PREFIX + sms.from_number
+            requested[key] = requested.get(key, 0) + 1
+            senders[key] = authenticated[sms.credentials + (sms.from_number,)][0]
+            strategies[key] = get_account_limiter(senders[key])
+            policies[key] = quota_policies.get(senders[key], sms.from_number)
+        remaining = update_usage_batch(requested, DEFAULT_SMS_LIMIT, DEFAULT_SMS_WINDOW, strategies, policies)
+
+        accepted = []
+        for index in allowed:
+            key = OUT_PREFIX + messages[index].from_number
+            if remaining[key] > 0:
+                remaining[key] -= 1
+                accepted.append(index)
+                results[index] = dict(error="", message="outbound sms ok")
+            else:
+                results[index] = dict(error="limit reached for from %s" % messages[index].from_number, message="")
+
+        # queue accepted smses for delivery in one go
+        if DISPATCH_ENABLED:
+            errors = enqueue_outbound_batch([
+                (senders[OUT_PREFIX + messages[index].from_number], messages[index].from_number,
+                 messages[index].to_number, messages[index].text) for index in accepted
+            ])
+            refunds = {}
+            for index, error in zip(accepted, errors):
+                if error:
+                    results[index] = dict(error=error, message="")
+                    key = OUT_PREFIX + messages[index].from_number
+                    refunds[key] = refunds.get(key, 0) + 1
+
+            # refused smses must not use up the quota of the retries
+            for key, count in refunds.items():
+                refund_usage(strategies[key], key, policies[key][0], policies[key][1], count)
+
+        for index in accepted:
+            if not results[index]["error"]:
+                from_number = messages[index].from_number
+                usage_recorder.record(senders[OUT_PREFIX + from_number], from_number, "outbound")
+
+        return respond(error="", message="outbound sms batch ok", results=results)
+
+    except ServiceUnavailable as e:
+        return respond(error=str(e), message="")
+    except Exception as e:
+        print e
+        return respond(error="unknown failure", message="")
+
+
+@app.route('/provision/', methods=['POST'])
+def provision_numbers():
+
+    # bulk load of accounts and numbers, body is csv or jsonl (?format=jsonl or application/x-ndjson)
+    token = app.config.get("PROVISION_TOKEN")
+    if not token or not hmac.compare_digest(str(request.headers.get("X-Provision-Token", "")), str(token)):
+        raise exceptions.Forbidden()
+
+    format = request.args.get("format") or ("jsonl" if "json" in request.mimetype else "csv")
+    try:
+        report = provision(request.stream, format)
+    except ValueError as e:
+        return respond(error=str(e), message="")
+    except Exception as e:
+        print e
+        return respond(error="unknown failure", message="")
+
+    return respond(error="", message="provisioning ok", **report.as_dict())
+
+
+@app.route('/usage/', methods=['POST'])
+def usage():
+
+    """
+    Sms counts of the account from the hourly or daily rollups.
+    Parameters (form or json): username, password, period ("hour" or "day"), optional number and start/end
+    as unix time
+    """
+    try:
+        data = request_data(request)
+        account_id = get_account_id(get_parameter(data, "username"), get_parameter(data, "password"))
+        if not account_id:
+            raise exceptions.Forbidden()
+
+        period = data.get("period") or "day"
+        if period not in PERIODS:
+            return respond(error="parameter 'period' is invalid", message="")
+        try:
+            end = float(data.get("end") or time.time())
+            start = float(data.get("start") or end - 30 * PERIODS[period])
+        except (TypeError, ValueError):
+            return respond(error="parameter 'start' or 'end' is invalid", message="")
+
+        number = get_parameter(data, "number")
+        rollups = query_usage(account_id, period, start, end, normalize_number(number) if number else None)
+        return respond(error="", message="usage ok", usage=rollups)
+
+    except exceptions.Forbidden as e:
+        raise e
+    except Exception as e:
+        print e
+        return respond(error="unknown failure", message="")
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+
+    # metrics of this process in prometheus text format
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
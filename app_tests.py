@@ -1,8 +1,26 @@
+import json
+import threading
 import unittest
 import time
-from multiprocessing import Process
+from multiprocessing import Process, Queue
+
+import redis
 from app import app, db
 from app.utils import *
+from app.cache import TTLCache, MISSING
+from app.limiter import get_limiter
+from app.bloom import BloomFilter, ExpiringBloomFilter
+from app.sharding import HashRing, shard_key
+from app import dispatch
+from app.dispatch import start_workers, DISPATCH_STREAM
+from app.message import parse_message
+from app.credentials import hash_secret, verify_secret, verifier_cache
+from app.accounting import usage_recorder
+from app.lifecycle import after_fork, warm_caches
+from app.directory import NumberDirectory, pack_number
+from app.models import StopRequest
+from app.breaker import CircuitBreaker
+from app.migrations import hash_auth_ids
 
 
 class AppTestCase(unittest.TestCase):
@@ -32,8 +50,13 @@ class AppTestCase(unittest.TestCase):
         db.session.remove()
         db.drop_all()
 
-        r = get_redis_connection()
-        r.flushall()
+        for r in get_redis_connections():
+            r.flushall()
+        stop_cache.clear()
+        usage_recorder.clear()
+        stop_store.clear()
+        quota_policies.clear()
+        number_directory.invalidate()
 
     def test_inbound(self):
 
@@ -296,6 +319,91 @@ class AppTestCase(unittest.TestCase):
         })
         assert "parameter 'text' is invalid" in rv.data
 
+    def test_inbound_batch(self):
+
+        message = {
+            "from": "+919916425256",
+            "to": "4924195509192",
+            "text": "STOP",
+            "username": "test123",
+            "password": "20S0KPNOIM"
+        }
+
+        rv = self.app.post('/inbound/sms/batch/', data=json.dumps([
+            message,
+            dict(message, **{"from": "+919916425257", "text": "Test messages"}),
+            dict(message, **{"from": "+919916425258", "password": "invalid"}),
+            dict(message, **{"from": "+919916425259", "to": "492419509192"}),
+            dict(message, **{"from": "1"}),
+        ]), content_type='application/json')
+
+        results = json.loads(rv.data)["results"]
+        assert results[0] == {"error": "", "message": "inbound sms ok"}
+        assert results[1] == {"error": "", "message": "inbound sms ok"}
+        assert results[2]["error"] == "403 Forbidden"
+        assert results[3]["error"] == "to parameter not found"
+        assert results[4]["error"] == "parameter 'from' is invalid"
+
+        # only valid stop requests are registered
+        assert check_stop_request("INBOUND_+919916425256", "4924195509192")
+        assert check_stop_request("INBOUND_+919916425257", "4924195509192") is None
+        assert check_stop_request("INBOUND_+919916425258", "4924195509192") is None
+
+    def test_outbound_batch(self):
+
+        message = {
+            "from": "4924195509192",
+            "to": "1234567643434",
+            "text": "Test messages",
+            "username": "test123",
+            "password": "20S0KPNOIM"
+        }
+        register_stop_request("STOP", "INBOUND_+919916425256", "4924195509192", 10)
+
+        rv = self.app.post('/outbound/sms/batch/', data=json.dumps([
+            message,
+            dict(message, password="invalid"),
+            dict(message, to="+919916425256"),
+            dict(message, text=""),
+            dict(message, **{"from": "+919916425256"}),
+        ]), content_type='application/json')
+
+        results = json.loads(rv.data)["results"]
+        assert results[0] == {"error": "", "message": "outbound sms ok"}
+        assert results[1]["error"] == "403 Forbidden"
+        assert results[2]["error"] == "sms from 4924195509192 to +919916425256 blocked by STOP request"
+        assert results[3]["error"] == "parameter 'text' is missing"
+        assert results[4]["error"] == "from parameter not found"
+
+        # sms beyond the limit are rejected
+        rv = self.app.post('/outbound/sms/batch/', data=json.dumps([message] * 50),
+                           content_type='application/json')
+        results = json.loads(rv.data)["results"]
+        assert all(result["message"] == "outbound sms ok" for result in results[:49])
+        assert results[49]["error"] == "limit reached for from 4924195509192"
+
+        # batch must be a json array
+        rv = self.app.post('/outbound/sms/batch/', data=json.dumps(message), content_type='application/json')
+        assert "batch must be a non empty json array" in rv.data
+
+    def test_metrics(self):
+
+        self.app.post('/outbound/sms/', data={
+            "from": "4924195509192",
+            "to": "1234567643434",
+            "text": "Test messages",
+            "username": "test123",
+            "password": "20S0KPNOIM"
+        })
+        self.app.post('/outbound/sms/', data={"from": "4924195509192", "to": "1234567643434"})
+
+        rv = self.app.get('/metrics')
+        assert 'sms_requests_total{endpoint="outbound",result="ok"}' in rv.data
+        assert 'sms_requests_total{endpoint="outbound",result="invalid_input"}' in rv.data
+        assert 'sms_stage_seconds_bucket{stage="authenticate",le="+Inf"}' in rv.data
+        assert 'sms_stage_seconds_count{stage="usage"}' in rv.data
+        assert 'sms_cache_lookups_total{cache="account",result="miss"}' in rv.data
+
     def test_stop_request(self):
 
         # register stop request
@@ -343,6 +451,141 @@ class AppTestCase(unittest.TestCase):
         r = check_stop_request("test_123344556677", "1212345678")
         assert "sms from %s to %s blocked by STOP request" == r
 
+    def test_stop_near_cache(self):
+
+        # wait for the subscription, lookups go to redis till then
+        stop_cache.start()
+        for _ in range(50):
+            if stop_cache.subscribed:
+                break
+            time.sleep(0.1)
+        assert stop_cache.subscribed
+
+        # negative result is cached
+        assert check_stop_request("INBOUND_3344556677", "12345678") is None
+        hits = stop_cache.cache.hits
+        assert check_stop_request("INBOUND_3344556677", "12345678") is None
+        assert stop_cache.cache.hits == hits + 1
+
+        # stop request registered by another process invalidates the cached entry
+        invalidations = stop_cache.invalidations
+        get_redis_connection("INBOUND_3344556677").set("INBOUND_3344556677", "12345678", ex=10)
+        stop_cache.publish(get_redis_connection(), "INBOUND_3344556677", "12345678", 10)
+        for _ in range(50):
+            if stop_cache.invalidations > invalidations:
+                break
+            time.sleep(0.1)
+        assert check_stop_request("INBOUND_3344556677", "12345678") == "sms from %s to %s blocked by STOP request"
+        assert stop_cache.stats()["last_invalidation_lag"] < 5
+
+        # cached negative does not let an sms through once the stop request is in redis
+        assert check_stop_request("INBOUND_3344556688", "12345678") is None
+        redis_conn = get_redis_connection("INBOUND_3344556688")
+        if redis_conn is get_redis_connection("OUTBOUND_12345678"):
+            redis_conn.set("INBOUND_3344556688", "12345678", ex=10)
+            assert update_usage("OUTBOUND_12345678", 5, 60, "fixed_window", "INBOUND_3344556688", "12345678").blocked
+
+    def test_unpublished_stop_request(self):
+
+        # two nodes on separate databases so stop requests and usage live apart
+        nodes = app.config["REDIS_NODES"]
+        app.config["REDIS_NODES"] = [dict(host="localhost", port=6379, db=0), dict(host="localhost", port=6379, db=1)]
+        reset_redis_connection()
+        try:
+            stop_cache.start()
+            for _ in range(50):
+                if stop_cache.subscribed:
+                    break
+                time.sleep(0.1)
+            assert stop_cache.subscribed
+
+            from_number = "12345678"
+            key = "OUTBOUND_" + from_number
+            stop_keys = ["INBOUND_%d" % number for number in xrange(3344556600, 3344556700)]
+            stop_key = [k for k in stop_keys if get_redis_connection(k) is not get_redis_connection(key)][0]
+
+            # negative is cached, the stop request then reaches redis without an invalidation
+            assert check_stop_request(stop_key, from_number) is None
+            assert stop_cache.get(stop_key) == ""
+            get_redis_connection(stop_key).set(stop_key, from_number, ex=10)
+
+            # batch and cross node paths read it from redis all the same
+            assert check_stop_requests([(stop_key, from_number)]) == ["sms from %s to %s blocked by STOP request"]
+            stop_cache.set(stop_key, None, stop_cache.generation)
+            assert stop_cache.get(stop_key) == ""
+            assert update_usage(key, 5, 60, "fixed_window", stop_key, from_number).blocked
+            assert get_redis_connection(key).get(key) is None
+        finally:
+            for r in get_redis_connections():
+                r.flushall()
+            app.config["REDIS_NODES"] = nodes
+            reset_redis_connection()
+
+    def test_bloom_filter(self):
+
+        bloom = BloomFilter(1000, 0.01)
+        for number in xrange(1000):
+            bloom.add("INBOUND_%s" % number)
+
+        # no false negatives and false positives close to the error rate
+        assert all("INBOUND_%s" % number in bloom for number in xrange(1000))
+        false_positives = sum("OTHER_%s" % number in bloom for number in xrange(10000))
+        assert false_positives < 300
+        assert 0.005 < bloom.false_positive_rate() < 0.02
+
+        # entries are dropped with their bucket once they expire
+        bloom = ExpiringBloomFilter(4, 4, 1000, 0.01)
+        bloom.add("INBOUND_1", 1)
+        bloom.add("INBOUND_2", 4)
+        assert "INBOUND_1" in bloom and "INBOUND_2" in bloom
+        time.sleep(2.1)
+        assert "INBOUND_1" not in bloom and "INBOUND_2" in bloom
+        assert bloom.stats()["entries"] == 1
+
+    def test_stop_filter(self):
+
+        # stop request registered before the filter is built is found in redis
+        get_redis_connection("INBOUND_+919916425256").set("INBOUND_+919916425256", "4924195509192", ex=10)
+        stop_cache.start()
+        for _ in range(50):
+            if stop_cache.filter_ready:
+                break
+            time.sleep(0.1)
+        stop_cache.build_filter()
+        # and seeds the snapshot served while redis is unavailable
+        assert stop_snapshot.get("INBOUND_+919916425256") == "4924195509192"
+
+        # numbers which never sent STOP are answered by the filter
+        negatives = stop_cache.filter_negatives
+        assert check_stop_request("INBOUND_+919916425257", "4924195509192") is None
+        assert stop_cache.filter_negatives == negatives + 1
+        assert check_stop_request("INBOUND_+919916425256", "4924195509192") == \
+            "sms from %s to %s blocked by STOP request"
+
+        # newly registered stop request is added to the filter
+        register_stop_request("STOP", "INBOUND_+919916425258", "4924195509192", 10)
+        assert check_stop_request("INBOUND_+919916425258", "4924195509192") == \
+            "sms from %s to %s blocked by STOP request"
+        assert stop_cache.stats()["filter_entries"] >= 2
+
+        # stop requests restored in bulk are found in redis till the reload rebuilds the filter, which every process
+        # does after a jitter and not more often than the reload interval
+        builds = stop_cache.filter_builds
+        get_redis_connection("INBOUND_+919916425259").set("INBOUND_+919916425259", "4924195509192", ex=10)
+        stop_cache.publish_reload(get_redis_connection())
+        for _ in range(50):
+            if not stop_cache.filter_ready:
+                break
+            time.sleep(0.1)
+        assert stop_cache.rebuild_at >= time.time() + stop_cache.reload_interval - 5
+        assert check_stop_request("INBOUND_+919916425259", "4924195509192") == \
+            "sms from %s to %s blocked by STOP request"
+        stop_cache.publish_reload(get_redis_connection())
+        time.sleep(1.1)
+        assert stop_cache.filter_builds == builds
+        stop_cache.build_filter()
+        assert stop_cache.filter_ready and stop_cache.rebuild_at is None
+
     def test_check_and_update_usage(self):
 
         # check if limit is getting updated properly and getting proper error message after limit exhaustion
@@ -360,12 +603,681 @@ class AppTestCase(unittest.TestCase):
         r = check_and_update_usage("1234567", 2, 10)
         assert r is None
 
+    def test_check_and_update_usage_independent_keys(self):
+
+        # exhausting limit for one number must not block other numbers
+        check_and_update_usage("1234567", 1, 10)
+        r = check_and_update_usage("1234567", 1, 10)
+        assert r == "limit reached for from %s"
+        r = check_and_update_usage("7654321", 1, 10)
+        assert r is None
+
+        # rejected requests must not extend the window
+        r = get_redis_connection()
+        assert int(r.get("1234567")) == 1
+        assert 0 < r.ttl("1234567") <= 10
+
+    def test_check_stop_and_usage(self):
+
+        # no stop request, usage gets updated
+        r = check_stop_and_usage("test_3344556677", "12345678", "12345678", 1, 10)
+        assert r == (None, None)
+
+        # limit reached
+        r = check_stop_and_usage("test_3344556677", "12345678", "12345678", 1, 10)
+        assert r == (None, "limit reached for from %s")
+
+        # blocked smses are not counted against the usage
+        register_stop_request("STOP", "test_3344556677", "87654321", 10)
+        r = check_stop_and_usage("test_3344556677", "87654321", "87654321", 1, 10)
+        assert r == ("sms from %s to %s blocked by STOP request", None)
+        assert get_redis_connection("87654321").get("87654321") is None
+
+    def test_redis_connection_is_shared(self):
+
+        # same connection is returned till it is reset
+        r = get_redis_connection()
+        assert r is get_redis_connection()
+        reset_redis_connection()
+        assert r is not get_redis_connection()
+
+    def test_ttl_cache(self):
+
+        cache = TTLCache(2, 1)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        assert cache.get("c") is MISSING
+
+        # least recently used entry is evicted, None is a valid cached value
+        cache.set("c", None)
+        assert cache.get("b") is MISSING
+        assert cache.get("c") is None
+        assert (cache.hits, cache.misses) == (2, 2)
+
+        # entries expire after ttl
+        time.sleep(1.1)
+        assert cache.get("a") is MISSING
+
+    def test_authenticate_account_cache(self):
+
+        form = {"username": "test123", "password": "20S0KPNOIM"}
+        assert authenticate_account(form, "4924195509192") is None
+        hits = account_cache.hits, number_cache.hits + number_directory.hits
+
+        # second lookup is answered from the cache or the number directory
+        assert authenticate_account(form, "4924195509192") is None
+        assert (account_cache.hits, number_cache.hits + number_directory.hits) == (hits[0] + 1, hits[1] + 1)
+
+        # negative result is dropped once the number is added
+        assert authenticate_account(form, "1234567890") == "%s parameter not found"
+        db.session.add(phone_number(number="1234567890", account_id=get_account_id("test123", "20S0KPNOIM")))
+        db.session.commit()
+        assert authenticate_account(form, "1234567890") is None
+
+    def test_hashed_auth_id(self):
+
+        # only the hash is stored
+        account = Account.query.filter_by(username="test123").first()
+        assert "20S0KPNOIM" not in account.auth_hash
+        assert account.check_auth_id("20S0KPNOIM")
+        assert not account.check_auth_id("20S0KPNOIN")
+
+        # successful verification is not hashed again
+        encoded = hash_secret("secret", iterations=1000)
+        assert verify_secret("secret", encoded)
+        hits = verifier_cache.hits
+        assert verify_secret("secret", encoded)
+        assert verifier_cache.hits == hits + 1
+
+    def test_provision(self):
+
+        app.config["PROVISION_TOKEN"] = "token"
+        data = "username,auth_id,number\n" \
+               "bulk,BULKSECRET1,+91 99164 25256\n" \
+               "bulk,,+919916425257\n" \
+               "bulk,,+919916425256\n" \
+               "test123,,4924195509192\n" \
+               "bulk,,4924195509192\n" \
+               "nobody,,+919916425258\n" \
+               "bulk,,1\n"
+
+        # token is required
+        rv = self.app.post('/provision/', data=data, content_type='text/csv')
+        assert rv.status_code == 403
+
+        rv = self.app.post('/provision/', data=data, content_type='text/csv', headers={"X-Provision-Token": "token"})
+        report = json.loads(rv.data)
+        app.config["PROVISION_TOKEN"] = None
+        assert (report["accounts_created"], report["numbers_created"], report["duplicates"]) == (1, 2, 2)
+        assert [error["line"] for error in report["errors"]] == [8, 6, 7]
+        assert report["errors"][1]["error"] == "number is owned by another account"
+
+        # provisioned numbers can be used right away
+        form = {"username": "bulk", "password": "BULKSECRET1"}
+        assert authenticate_account(form, "+919916425257") is None
+
+        # malformed json lines are rejected one by one, the rest of the load goes on
+        app.config["PROVISION_TOKEN"] = "token"
+        data = '{"username": "bulk", "number": "+919916425259"}\n' \
+               '{"username": "bulk", "number": \n' \
+               '\n' \
+               '{"username": "bulk", "number": "+919916425260"}\n'
+        rv = self.app.post('/provision/?format=jsonl', data=data, headers={"X-Provision-Token": "token"})
+        report = json.loads(rv.data)
+        app.config["PROVISION_TOKEN"] = None
+        assert report["numbers_created"] == 2
+        assert report["errors"] == [dict(line=2, number=None, error="line is not valid json")]
+
+    def test_usage_rollups(self):
+
+        data = {
+            "from": "4924195509192",
+            "to": "1234567643434",
+            "text": "Test messages",
+            "username": "test123",
+            "password": "20S0KPNOIM"
+        }
+        self.app.post('/outbound/sms/', data=data)
+        self.app.post('/outbound/sms/', data=data)
+        self.app.post('/inbound/sms/', data=dict(data, **{"from": "+919916425256", "to": "4924195509192"}))
+
+        # counts are written to the rollups by the flush
+        usage_recorder.flush()
+        rv = self.app.post('/usage/', data={"username": "test123", "password": "20S0KPNOIM", "period": "hour"})
+        usage = json.loads(rv.data)["usage"]
+        assert [(rollup["number"], rollup["inbound"], rollup["outbound"]) for rollup in usage] == \
+            [("4924195509192", 1, 2)]
+
+        # later counts are added to the same rollup
+        self.app.post('/outbound/sms/', data=data)
+        usage_recorder.flush()
+        rv = self.app.post('/usage/', data=json.dumps({"username": "test123", "password": "20S0KPNOIM",
+                                                       "number": 4924195509192}), content_type="application/json")
+        assert json.loads(rv.data)["usage"][0]["outbound"] == 3
+
+        # credentials are not accepted in the query string
+        rv = self.app.get('/usage/?username=test123&password=20S0KPNOIM')
+        assert rv.status_code == 405
+
+    def test_plain_auth_id(self):
+
+        # accounts created before auth ids were hashed are hashed on their next login
+        db.session.add(Account(username="legacy", plain_auth_id="LEGACY1"))
+        db.session.add(Account(username="legacy2", plain_auth_id="LEGACY2"))
+        db.session.commit()
+        assert get_account_id("legacy", "LEGACY2") is None
+        account_id = get_account_id("legacy", "LEGACY1")
+        db.session.expire_all()
+        account = Account.query.get(account_id)
+        assert account.plain_auth_id is None and "LEGACY1" not in account.auth_hash
+        assert account.check_auth_id("LEGACY1")
+
+        # and the others by the migration
+        hash_auth_ids(None)
+        db.session.expire_all()
+        account = Account.query.filter_by(username="legacy2").first()
+        assert account.plain_auth_id is None and account.check_auth_id("LEGACY2")
+
+    def test_find_account_number(self):
+
+        account_id = get_account_id("test123", "20S0KPNOIM")
+        assert find_account_number("test123", "20S0KPNOIM", "4924195509192") == (account_id, True)
+
+        # number does not belong to the account
+        assert find_account_number("test123", "20S0KPNOIM", "492419509192") == (account_id, False)
+
+        # invalid credentials
+        assert find_account_number("plivo", "20S0KPNOIM", "4924195509192") == (None, False)
+
+    def test_rate_limiters(self):
+
+        r = get_redis_connection()
+        for name in ["fixed_window", "sliding_window", "token_bucket"]:
+            limiter = get_limiter(name)
+
+            result = limiter.hit(r, "limiter_" + name, 2, 10)
+            assert (result.allowed, result.remaining) == (1, 1)
+
+            # only as many smses as the quota permits are allowed
+            result = limiter.hit(r, "limiter_" + name, 2, 10, count=2)
+            assert (result.allowed, result.remaining) == (1, 0)
+            assert 0 < result.retry_after <= 10
+            assert 0 < result.reset <= 20
+
+        # token bucket refills gradually
+        time.sleep(5)
+        assert get_limiter("token_bucket").hit(r, "limiter_token_bucket", 2, 10).allowed == 1
+        assert get_limiter("token_bucket").hit(r, "limiter_token_bucket", 2, 10).allowed == 0
+
+    def test_outbound_rate_limit_headers(self):
+
+        data = {
+            "from": "4924195509192",
+            "to": "1234567643434",
+            "text": "Test messages",
+            "username": "test123",
+            "password": "20S0KPNOIM"
+        }
+        rv = self.app.post('/outbound/sms/', data=data)
+        assert rv.headers["X-RateLimit-Limit"] == "50"
+        assert rv.headers["X-RateLimit-Remaining"] == "49"
+
+        # account configured for token bucket
+        Account.query.filter_by(username="test123").update({"rate_limiter": "token_bucket"})
+        db.session.commit()
+        limiter_cache.clear()
+        rv = self.app.post('/outbound/sms/', data=data)
+        assert "outbound sms ok" in rv.data
+        assert rv.headers["X-RateLimit-Remaining"] == "49"
+        assert get_redis_connection("OUTBOUND_4924195509192").exists("{OUTBOUND_4924195509192}:bucket")
+
+    def test_parse_message(self):
+
+        sms, error = parse_message({"from": "+91 99164-25256", "to": 4924195509192, "text": "STOP"})
+        assert error is None
+        assert (sms.from_number, sms.to_number, sms.text) == ("+919916425256", "4924195509192", "STOP")
+
+        # error of the last wrong parameter is reported, missing parameters first
+        assert parse_message({"from": "1", "to": "2"}) == (None, "parameter 'text' is missing")
+        assert parse_message({"from": "1", "to": "2", "text": "a"}) == (None, "parameter 'to' is invalid")
+        assert parse_message({"from": "49241955O9192", "to": "4924195509192", "text": "a"}) == \
+            (None, "parameter 'from' is invalid")
+
+        # json body is accepted as well
+        rv = self.app.post('/outbound/sms/', data=json.dumps({
+            "from": "4924 195 509 192",
+            "to": "1234567643434",
+            "text": "Test messages",
+            "username": "test123",
+            "password": "20S0KPNOIM"
+        }), content_type='application/json')
+        assert "outbound sms ok" in rv.data
+
+    def test_idempotency_key(self):
+
+        data = {
+            "from": "4924195509192",
+            "to": "1234567643434",
+            "text": "Test messages",
+            "username": "test123",
+            "password": "20S0KPNOIM"
+        }
+        headers = {"Idempotency-Key": "retry-1"}
+        rv = self.app.post('/outbound/sms/', data=data, headers=headers)
+        assert "outbound sms ok" in rv.data
+
+        # retry is answered with the stored response, quota is used once
+        rv = self.app.post('/outbound/sms/', data=data, headers=headers)
+        assert "outbound sms ok" in rv.data
+        assert rv.headers["Idempotent-Replayed"] == "true"
+        assert rv.headers["X-RateLimit-Remaining"] == "49"
+        assert int(get_redis_connection("OUTBOUND_4924195509192").get("OUTBOUND_4924195509192")) == 1
+
+        # key reused for a different sms is rejected
+        rv = self.app.post('/outbound/sms/', data=dict(data, text="other"), headers=headers)
+        assert rv.status_code == 422
+
+        # non ascii credentials are hashed rather than failing the request
+        rv = self.app.post('/outbound/sms/', data=dict(data, password=u"p\u00e4ss"), headers=headers)
+        assert rv.status_code == 403
+
+    def test_idempotency_retryable(self):
+
+        data = {
+            "from": "4924195509192",
+            "to": "1234567643434",
+            "text": "Test messages",
+            "username": "test123",
+            "password": "20S0KPNOIM"
+        }
+        # sms refused by a full queue is sent by the retry
+        headers = {"Idempotency-Key": "retry-1"}
+        backlog = dispatch.DISPATCH_MAX_BACKLOG
+        dispatch.DISPATCH_MAX_BACKLOG = 0
+        try:
+            rv = self.app.post('/outbound/sms/', data=data, headers=headers)
+            assert dispatch.QUEUE_FULL_ERROR in rv.data
+        finally:
+            dispatch.DISPATCH_MAX_BACKLOG = backlog
+        rv = self.app.post('/outbound/sms/', data=data, headers=headers)
+        assert "outbound sms ok" in rv.data
+        assert "Idempotent-Replayed" not in rv.headers
+
+        # so is the sms refused by the quota once the window is over
+        headers = {"Idempotency-Key": "retry-2"}
+        redis_conn = get_redis_connection("OUTBOUND_4924195509192")
+        redis_conn.set("OUTBOUND_4924195509192", 50, ex=60)
+        rv = self.app.post('/outbound/sms/', data=data, headers=headers)
+        assert "limit reached" in rv.data
+        assert "Retry-After" in rv.headers
+        redis_conn.delete("OUTBOUND_4924195509192")
+        rv = self.app.post('/outbound/sms/', data=data, headers=headers)
+        assert "outbound sms ok" in rv.data
+        assert "Idempotent-Replayed" not in rv.headers
+
+    def test_quota_tiers(self):
+
+        data = {
+            "from": "4924195509192",
+            "to": "1234567643434",
+            "text": "Test messages",
+            "username": "test123",
+            "password": "20S0KPNOIM"
+        }
+        rv = self.app.post('/outbound/sms/', data=data)
+        assert rv.headers["X-RateLimit-Limit"] == "50"
+
+        # tier of the account applies to all its numbers, without a query per request
+        tier = QuotaTier(name="small", sms_limit=2, window_seconds=3600)
+        db.session.add(tier)
+        db.session.commit()
+        Account.query.filter_by(username="test123").update({"quota_tier_id": tier.id})
+        db.session.commit()
+        quota_policies.invalidate()
+        quota_policies.load()
+        assert quota_policies.get(get_account_id("test123", "20S0KPNOIM"), "4924195509192") == (2, 3600)
+        loads = quota_policies.loads
+        rv = self.app.post('/outbound/sms/', data=data)
+        assert rv.headers["X-RateLimit-Limit"] == "2"
+        assert "limit reached" in self.app.post('/outbound/sms/', data=data).data
+        assert quota_policies.loads == loads
+
+        # tier of the number overrides it
+        large = QuotaTier(name="large", sms_limit=1000, window_seconds=3600)
+        db.session.add(large)
+        db.session.commit()
+        phone_number.query.filter_by(number="4924195509192").update({"quota_tier_id": large.id})
+        db.session.commit()
+        quota_policies.invalidate()
+        quota_policies.load()
+        rv = self.app.post('/outbound/sms/', data=data)
+        assert rv.headers["X-RateLimit-Limit"] == "1000"
+
+    def test_redis_unavailable(self):
+
+        port, share = app.config["REDIS_PORT"], local_limiter.share
+        app.config["REDIS_PORT"] = 1
+        reset_redis_connection()
+        # this is the only process granting usage
+        local_limiter.share = 1.0
+        try:
+            # stop requests and usage are kept in process while redis is down
+            register_stop_request("STOP", "INBOUND_+919916425256", "4924195509192", 60)
+            assert check_stop_request("INBOUND_+919916425256", "4924195509192") == \
+                "sms from %s to %s blocked by STOP request"
+            assert check_and_update_usage("12345678", 2, 60) is None
+            assert check_and_update_usage("12345678", 2, 60) is None
+            assert check_and_update_usage("12345678", 2, 60) == "limit reached for from %s"
+            assert redis_breaker.is_open
+
+            # requests carrying Idempotency-Key are executed without deduplication
+            rv = self.app.post('/inbound/sms/', headers={"Idempotency-Key": "retry-1"}, data={
+                "from": "+919916425256",
+                "to": "4924195509192",
+                "text": "hello",
+                "username": "test123",
+                "password": "20S0KPNOIM"
+            })
+            assert "inbound sms ok" in rv.data
+        finally:
+            app.config["REDIS_PORT"] = port
+            local_limiter.share = share
+            reset_redis_connection()
+
+        # next call after the reset timeout probes redis, local state is added to it once it succeeds
+        redis_breaker.opened_at = 0
+        assert check_and_update_usage("87654321", 2, 60) is None
+        assert not redis_breaker.is_open
+        for _ in range(50):
+            if get_redis_connection("12345678").get("12345678"):
+                break
+            time.sleep(0.1)
+        assert int(get_redis_connection("12345678").get("12345678")) == 2
+        assert get_redis_connection("INBOUND_+919916425256").get("INBOUND_+919916425256") == "4924195509192"
+
+    def test_breaker_pool_exhausted(self):
+
+        # calls which found no free connection fall back but only redis failures open the circuit
+        breaker = CircuitBreaker("test", 1, 60)
+
+        def exhausted():
+            raise redis.ConnectionError("No connection available.")
+
+        def unavailable():
+            raise redis.ConnectionError("Error 111 connecting to localhost:1. Connection refused.")
+
+        assert breaker.fallback(lambda: "local")(exhausted)() == "local"
+        assert not breaker.is_open
+        assert breaker.fallback(lambda: "local")(unavailable)() == "local"
+        assert breaker.is_open
+
+        # an error shared by coalesced callers is one failure
+        breaker = CircuitBreaker("test", 2, 60)
+        error = redis.ConnectionError("Error 111 connecting to localhost:1. Connection refused.")
+
+        def shared():
+            raise error
+
+        assert breaker.fallback(lambda: "local")(shared)() == "local"
+        assert breaker.fallback(lambda: "local")(shared)() == "local"
+        assert breaker.failures == 1 and not breaker.is_open
+
+    def test_warm_caches(self):
+
+        # new worker answers ownership and limiter lookups without querying
+        after_fork()
+        limiter_cache.clear()
+        assert warm_caches(timeout=5)["directory"] == 1
+        account_id = get_account_id("test123", "20S0KPNOIM")
+        hits = number_directory.hits, limiter_cache.hits
+        assert is_number_owned(account_id, "4924195509192")
+        get_account_limiter(account_id)
+        assert (number_directory.hits, limiter_cache.hits) == (hits[0] + 1, hits[1] + 1)
+
+    def test_stop_request_store(self):
+
+        # stop requests are written behind to postgres
+        register_stop_request("STOP", "INBOUND_919916425256", "4924195509192", 4 * 3600)
+        register_stop_request("STOP", "INBOUND_919916425257", "4924195509192", 4 * 3600)
+        assert stop_store.flush() == 2
+        assert StopRequest.query.get("INBOUND_919916425256").value == "4924195509192"
+
+        # and restored once redis lost them, keys registered meanwhile are kept
+        for r in get_redis_connections():
+            r.flushall()
+        get_redis_connection("INBOUND_919916425257").set("INBOUND_919916425257", "4924195509193")
+        report = stop_store.restore(force=True)
+        assert report["nodes"] == len(get_redis_connections())
+        redis_conn = get_redis_connection("INBOUND_919916425256")
+        assert redis_conn.get("INBOUND_919916425256") == "4924195509192"
+        assert 0 < redis_conn.ttl("INBOUND_919916425256") <= 4 * 3600
+        assert get_redis_connection("INBOUND_919916425257").get("INBOUND_919916425257") == "4924195509193"
+
+        # nodes holding the restored stop requests are skipped
+        assert stop_store.restore() is None
+
+        # a restore left unfinished by a process which died is taken over once its claim expires
+        for r in get_redis_connections():
+            r.set(stop_store.marker, "restoring:0:0", ex=1)
+        assert stop_store.restore() is None
+        time.sleep(1.1)
+        assert stop_store.restore()["nodes"] == len(get_redis_connections())
+
+        # a replica promoted after a failover inherits the marker of the old master but not its last writes
+        redis_conn = get_redis_connection("INBOUND_919916425256")
+        redis_conn.delete("INBOUND_919916425256")
+        assert stop_store.restore() is None
+        redis_conn.set(stop_store.marker, "restored:%s:0" % ("0" * 40))
+        assert stop_store.restore()["restored"] == 1
+        assert redis_conn.get("INBOUND_919916425256") == "4924195509192"
+        assert redis_conn.get(stop_store.marker).startswith("restored:%s:" % redis_conn.info("server")["run_id"])
+
+        # a process which lost its claim does not overwrite the claim of the one which took over
+        claims = []
+        original = stop_store.unexpired
+
+        def unexpired():
+            for rows in original():
+                redis_conn.set(stop_store.marker, "restoring:1:1", ex=10)
+                claims.append(rows)
+                yield rows
+        stop_store.unexpired = unexpired
+        try:
+            redis_conn.delete(stop_store.marker)
+            assert stop_store.restore()["nodes"] == 1
+        finally:
+            del stop_store.unexpired
+        assert claims and redis_conn.get(stop_store.marker) == "restoring:1:1"
+
+    def test_request_coalescing(self):
+
+        # concurrent identical lookups share one call
+        flight = SingleFlight()
+        calls = []
+        results = []
+
+        def lookup(value):
+            calls.append(value)
+            time.sleep(0.1)
+            return value
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do("key", lookup, 1))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [1] * 10 and len(calls) == 1
+
+        # hits of a number arriving while a call is in flight are applied together by the next call,
+        # every caller still gets an exact answer
+        limiter = get_limiter("fixed_window")
+
+        class SlowLimiter(object):
+            name = limiter.name
+
+            def hit_each(self, *args, **kwargs):
+                time.sleep(0.1)
+                return limiter.hit_each(*args, **kwargs)
+
+        batcher = HitBatcher()
+        redis_conn = get_redis_connection("OUTBOUND_4924195509192")
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            batcher.hit(SlowLimiter(), redis_conn, "OUTBOUND_4924195509192", 7, 60))) for _ in range(10)]
+        threads[0].start()
+        time.sleep(0.05)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert (batcher.batches, batcher.batched) == (2, 10)
+        assert sorted(result.remaining for result in results if result.allowed) == range(7)
+        assert all(result.retry_after > 0 for result in results if not result.allowed)
+        assert redis_conn.get("OUTBOUND_4924195509192") == "7"
+
+    def test_outbound_batching(self):
+
+        # concurrent outbound smses of a number check their stop requests and quota by one script call
+        key = "OUTBOUND_4924195509193"
+        redis_conn = get_redis_connection(key)
+        assert get_redis_connection("INBOUND_+919916425260") is redis_conn
+        # stop request registered by another process whose invalidation has not arrived yet
+        redis_conn.set("INBOUND_+919916425260", "4924195509193", ex=60)
+        get_limiter("fixed_window").hit(redis_conn, key + "_warmup", 3, 60)
+
+        def scripts():
+            return redis_conn.info("commandstats").get("cmdstat_evalsha", {}).get("calls", 0)
+
+        # hold a call in flight so that all the smses queue behind it
+        flight_key = ("fixed_window", key, 3, 60)
+        held = [threading.Event(), [None], None, None, None]
+        hit_batcher._flights[flight_key] = held
+        numbers = ["+91991642526%d" % index for index in range(5)]
+        results = {}
+
+        def send(number):
+            results[number] = update_usage(key, 3, 60, "fixed_window", "INBOUND_" + number, "4924195509193")
+
+        threads = [threading.Thread(target=send, args=(number,)) for number in numbers]
+        for thread in threads:
+            thread.start()
+        for _ in range(50):
+            if held[4] is not None and len(held[4][1]) == len(numbers):
+                break
+            time.sleep(0.01)
+
+        calls = scripts()
+        hit_batcher._land(flight_key, held)
+        for thread in threads:
+            thread.join()
+        assert scripts() == calls + 1
+        assert results["+919916425260"].blocked
+        assert sorted(results[number].allowed for number in numbers[1:]) == [0, 1, 1, 1]
+        assert redis_conn.get(key) == "3"
+
+    def test_number_directory(self):
+
+        # numbers differing only in the plus or leading zeros are packed to distinct keys
+        keys = [pack_number(number) for number in ["4924195509192", "+4924195509192", "004924195509192"]]
+        assert len(set(keys)) == 3
+        assert pack_number("49241955091921234") is None
+
+        account_id = get_account_id("test123", "20S0KPNOIM")
+        other = Account(username="other", auth_id="OTHER")
+        db.session.add(other)
+        db.session.commit()
+        db.session.add_all([phone_number(number=number, account_id=account_id)
+                            for number in ["+919916425256", "123456", "99999999"]])
+        db.session.add(phone_number(number="123456", account_id=other.id))
+        db.session.commit()
+
+        # rows are read in chunks of two and merged into one sorted directory
+        directory = NumberDirectory("test_channel", 2, 100, 300)
+        directory.load()
+        assert len(directory) == 5
+        assert directory.contains(account_id, "4924195509192") and directory.contains(account_id, 123456)
+        assert directory.contains(other.id, "123456")
+        assert not directory.contains(other.id, "+919916425256")
+        assert not directory.contains(account_id, "0123456")
+
+        # changes are kept in the overlay till the next load
+        directory.discard(account_id, "123456")
+        directory.add(other.id, "55555555")
+        assert not directory.contains(account_id, "123456") and directory.contains(other.id, "55555555")
+        directory.load()
+        assert directory.contains(account_id, "123456") and not directory.contains(other.id, "55555555")
+
+        # a number moved to another account is dropped from the previous one without a reload
+        number_directory.load()
+        moved = phone_number.query.filter_by(number="99999999").first()
+        moved.account_id = other.id
+        db.session.commit()
+        assert number_directory.ready and not number_directory.contains(account_id, "99999999")
+
+    def test_hash_ring(self):
+
+        # hash tagged keys are stored together
+        assert shard_key("{OUTBOUND_123}:bucket") == "OUTBOUND_123"
+        assert shard_key("OUTBOUND_123") == "OUTBOUND_123"
+        assert shard_key("{}OUTBOUND_123") == "{}OUTBOUND_123"
+
+        keys = ["OUTBOUND_%d" % number for number in range(10000)]
+        ring = HashRing([("node%d" % number, number) for number in range(4)])
+        assert ring.get("{OUTBOUND_1}:5") == ring.get("OUTBOUND_1")
+
+        # keys are spread over all the nodes
+        owners = dict((key, ring.get(key)) for key in keys)
+        assert all(1500 < owners.values().count(node) < 3500 for node in range(4))
+
+        # adding a node moves only the keys taken over by it
+        ring = HashRing([("node%d" % number, number) for number in range(5)])
+        moved = [key for key in keys if ring.get(key) != owners[key]]
+        assert all(ring.get(key) == 4 for key in moved)
+        assert len(moved) < 3000
+
+    def test_outbound_dispatch(self):
+
+        # accepted sms is queued for delivery
+        rv = self.app.post('/outbound/sms/', data={
+            "from": "4924195509192",
+            "to": "1234567643434",
+            "text": "Test messages",
+            "username": "test123",
+            "password": "20S0KPNOIM"
+        })
+        assert "outbound sms ok" in rv.data
+        r = get_redis_connection(DISPATCH_STREAM)
+        assert r.xlen(DISPATCH_STREAM) == 1
+
+        # worker hands it over to the handler and removes it from the stream
+        delivered = []
+        workers, stopped = start_workers(1, lambda messages: delivered.extend(messages) or [])
+        for _ in range(50):
+            if delivered:
+                break
+            time.sleep(0.1)
+        stopped.set()
+        workers[0].join()
+        assert delivered[0][1]["to"] == "1234567643434"
+        assert r.xlen(DISPATCH_STREAM) == 0
+
+        # smses refused by a full queue give their quota back
+        for strategy in ("fixed_window", "sliding_window", "token_bucket"):
+            limiter = get_limiter(strategy)
+            key = "OUTBOUND_refund_" + strategy
+            redis_conn = get_redis_connection(key)
+            assert limiter.hit(redis_conn, key, 2, 60, count=2).remaining == 0
+            assert limiter.refund(redis_conn, key, 2, 60) == 1
+            assert limiter.hit(redis_conn, key, 2, 60).allowed == 1
+
     def test_concurrent_check_and_update_usage(self):
 
-        # create 3 processes each will update usage count
-        for num in range(3):
-            p = Process(target=check_and_update_usage, args=("12345678", 3, 6))
+        # create 3 processes each will update usage count, all of them run in parallel
+        processes = [Process(target=check_and_update_usage, args=("12345678", 3, 6)) for num in range(3)]
+        for p in processes:
             p.start()
+        for p in processes:
             p.join()
 
         # Limit must be exhausted. Error will be returned in case of further use
@@ -377,6 +1289,24 @@ class AppTestCase(unittest.TestCase):
         r = check_and_update_usage("12345678", 3, 6)
         assert r is None
 
+    def test_concurrent_usage_is_exact(self):
+
+        # many processes compete for the same quota, exactly limit of them must succeed
+        queue = Queue()
+
+        def use():
+            queue.put(check_and_update_usage("12345678", 5, 10))
+
+        processes = [Process(target=use) for num in range(20)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+
+        results = [queue.get() for num in range(20)]
+        assert results.count(None) == 5
+        assert int(get_redis_connection("12345678").get("12345678")) == 5
+
 if __name__ == '__main__':
     unittest.main()
 
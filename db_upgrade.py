@@ -0,0 +1,7 @@
+from app import db
+from app.migrations import upgrade
+
+# create missing tables and bring existing ones up to date
+db.create_all()
+for name in upgrade():
+    print "applied %s" % name
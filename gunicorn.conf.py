@@ -0,0 +1,42 @@
+# Production server: gunicorn -c gunicorn.conf.py app:app
+#
+# The application is loaded once by the master and forked into the workers, each worker drops the inherited
+# database and redis connections and fills its caches before it accepts requests.
+#
+#   kill -HUP <master>   restarts the workers gracefully, new ones start before old ones finish their requests
+#   kill -USR2 <master>  starts a new master with new code, then kill -QUIT the old one once the new one is up
+#   kill -TERM <master>  stops accepting and exits after finishing requests in flight
+import multiprocessing
+
+from app import config
+
+bind = config.SERVER_BIND
+workers = config.SERVER_WORKERS or multiprocessing.cpu_count()
+worker_class = "gthread"
+threads = config.SERVER_THREADS
+preload_app = True
+graceful_timeout = config.SERVER_GRACEFUL_TIMEOUT
+timeout = config.SERVER_GRACEFUL_TIMEOUT + config.SERVER_WARMUP_TIMEOUT
+keepalive = 5
+# recycle workers now and then, jitter keeps them from restarting all at once
+max_requests = 100000
+max_requests_jitter = 10000
+
+
+def post_fork(server, worker):
+    from app.lifecycle import after_fork
+    after_fork()
+
+
+def post_worker_init(worker):
+    # an exception here halts the master, a worker which could not warm up serves with cold caches instead
+    from app.lifecycle import warm_caches
+    try:
+        worker.log.info("worker %s warmed up %s", worker.pid, warm_caches())
+    except Exception:
+        worker.log.exception("worker %s failed to warm up, serving with cold caches", worker.pid)
+
+
+def worker_exit(server, worker):
+    from app.lifecycle import before_exit
+    before_exit()
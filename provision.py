@@ -0,0 +1,37 @@
+"""
+Bulk load of accounts and phone numbers.
+
+    python provision.py numbers.csv
+    python provision.py numbers.jsonl --chunk-size 10000
+
+csv input needs a header row with username, number and auth_id columns, jsonl input one object per line
+with the same keys. auth_id is needed only for accounts which do not exist yet. Loading the same file again
+is safe, numbers already provisioned are counted as duplicates.
+"""
+import argparse
+import json
+
+from app.config import PROVISION_CHUNK_SIZE
+from app.provisioning import provision, FORMATS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="bulk load of accounts and phone numbers")
+    parser.add_argument("path", help="csv or jsonl file")
+    parser.add_argument("--format", choices=FORMATS, help="input format, guessed from the extension if not given")
+    parser.add_argument("--chunk-size", type=int, default=PROVISION_CHUNK_SIZE, help="rows per transaction")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    format = args.format or ("jsonl" if args.path.endswith((".jsonl", ".json", ".ndjson")) else "csv")
+
+    with open(args.path) as lines:
+        report = provision(lines, format, args.chunk_size)
+
+    print json.dumps(report.as_dict(), indent=2)
+
+
+if __name__ == "__main__":
+    main()
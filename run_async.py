@@ -0,0 +1,23 @@
+# Cooperative serving mode: every request runs in a greenlet, redis and postgres i/o yield instead of blocking,
+# so a single process can hold thousands of requests in flight. Patching must happen before anything else is imported.
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from app import app
+from app.utils import reset_redis_connection
+
+# greenlets queue for a redis connection instead of failing after the short wait meant for worker threads
+app.config["REDIS_MAX_CONNECTIONS"] = app.config["ASYNC_REDIS_MAX_CONNECTIONS"]
+app.config["REDIS_POOL_TIMEOUT"] = app.config["ASYNC_REDIS_POOL_TIMEOUT"]
+reset_redis_connection()
+
+server = WSGIServer((app.config["ASYNC_HOST"], app.config["ASYNC_PORT"]), app,
+                    spawn=Pool(app.config["ASYNC_MAX_CONCURRENCY"]))
+print "serving on %s:%s" % server.address
+server.serve_forever()
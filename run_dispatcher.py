@@ -0,0 +1,22 @@
+import signal
+import sys
+import time
+
+from app.config import DISPATCH_WORKERS
+from app.dispatch import start_workers
+
+# delivers queued outbound smses, run as many of these processes as needed
+count = int(sys.argv[1]) if len(sys.argv) > 1 else DISPATCH_WORKERS
+workers, stopped = start_workers(count)
+print "started %d dispatch workers" % count
+
+# finish the batches in hand on SIGTERM/SIGINT
+signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+try:
+    while not stopped.is_set():
+        time.sleep(1)
+except KeyboardInterrupt:
+    stopped.set()
+
+for worker in workers:
+    worker.join()